@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from contextlib import aclosing
+from typing import AsyncIterator, Iterator, List
+
+from g4f import ChatCompletion
+
+from metrics import BACKOFF_SECONDS
+from upstream import pool
+
+# Background event loop used by the synchronous Flask views, so both serving
+# modes run the same async generation code.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="aio-loop", daemon=True).start()
+    return _loop
+
+
+def run_sync(coro):
+    # Run a coroutine on the background loop and block until it finishes
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def iter_sync(agen: AsyncIterator) -> Iterator:
+    # Drive an async generator from a synchronous (WSGI) response iterator
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # Runs on normal exit and when the WSGI server closes us on disconnect
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+def chunk_text(chunk) -> str:
+    if isinstance(chunk, str):
+        return chunk
+    return getattr(chunk, 'content', str(chunk))
+
+
+async def stream_chunks(provider, messages: List[dict], model='', timeout: int = 30):
+    # Non-blocking equivalent of ChatCompletion.create(..., stream=True).
+    # An empty model lets the provider pick its default one.
+    response = ChatCompletion.create_async(
+        model=model,
+        messages=messages,
+        stream=True,
+        provider=provider,
+        timeout=timeout,
+        **pool.kwargs(provider)
+    )
+    # Closing it is what cancels the upstream HTTP request when we stop early
+    async with aclosing(response):
+        async for chunk in response:
+            content = chunk_text(chunk)
+            if content:
+                yield content
+
+
+async def complete(provider, messages: List[dict], model='', timeout: int = 30) -> str:
+    response = await ChatCompletion.create_async(
+        model=model,
+        messages=messages,
+        stream=False,
+        provider=provider,
+        timeout=timeout,
+        **pool.kwargs(provider)
+    )
+    return chunk_text(response)
+
+
+async def backoff(attempt: int):
+    delay = 2 ** attempt
+    BACKOFF_SECONDS.inc(amount=delay)
+    await asyncio.sleep(delay)
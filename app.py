@@ -1,437 +1,583 @@
 # pip install asgiref uvicorn flask flask-cors g4f
 from flask import Flask, Response, request, stream_with_context, jsonify
 from flask_cors import CORS
-from g4f import ChatCompletion, models, Provider
-from g4f.Provider.base_provider import BaseProvider
-from json import dumps
+from quart import Quart, Response as AsyncResponse, request as async_request, jsonify as async_jsonify
+from quart_cors import cors
 import time
 from uuid import uuid4
-from shutil import rmtree
-from os import path
-import atexit
+from os import environ
 from asgiref.wsgi import WsgiToAsgi
 import logging
-from typing import List
+from contextlib import aclosing
+from functools import partial
+
+from aio import get_loop, iter_sync, run_sync
+from core import (admit, auto_provider, cached, fit_context, full_text, generate_text, microbatcher,
+                  request_deadline, response_cache, router, sessions, shared_text, translation_memory, warmup)
+from context_budget import count_tokens, message_tokens
+from microbatch import microbatch_enabled, short_text
+from scheduler import BATCH, Overloaded, request_tenant, scheduler
+from sessions import SessionNotFound
+from upstream import pool
+from routing import DEFAULT_MODEL
+from response_cache import CACHE_ENABLED, cache_key, replay_chunks, request_key
+from translation_memory import (batch_messages, memory_context, memory_document, memory_enabled, parse_batch,
+                                split_segments)
+from sse import (OPENAI_DONE, OPENAI_ERROR, anthropic_delta, anthropic_start, anthropic_stop, coalesce,
+                 openai_delta)
+from batch import stream_batch
+from metrics import instrument_stream, render, track_request
+import tracing
 
 app = Flask(__name__)
 CORS(app)
 
+# Native asyncio app serving the same routes without a thread per request
+aio_app = cors(Quart(__name__))
+aio_app.config['RESPONSE_TIMEOUT'] = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Cleanup function for cookies directory
-@atexit.register
-def remove_cookie():
-    if path.exists(cookie := 'har_and_cookies'):
-        rmtree(cookie)
-
-# Configure providers
-ACTIVE_PROVIDERS = [
-    Provider.Copilot,
-    Provider.Yqcloud,
-    Provider.ChatGptEs,
-    Provider.PollinationsAI,
-    Provider.Glider,
-    Provider.Liaobots,
-    Provider.Phind,
-]
-
-class AutoProvider:
-    def __init__(self, providers: List[BaseProvider]):
-        self.providers = providers
-        self.current_provider = None
-        self.last_failure = {}
-        self.retry_delay = 300  # 5 minutes in seconds
-
-    def get_provider(self):
-        current_time = time.time()
-        
-        # Try current provider first if available
-        if self.current_provider:
-            last_fail_time = self.last_failure.get(self.current_provider.__name__, 0)
-            if current_time - last_fail_time > self.retry_delay:
-                return self.current_provider
-            self.current_provider = None
-            
-        # Find a working provider
-        for provider in self.providers:
-            last_fail_time = self.last_failure.get(provider.__name__, 0)
-            if current_time - last_fail_time > self.retry_delay:
-                self.current_provider = provider
-                return provider
-        raise Exception("All providers are temporarily unavailable")
-
-    def mark_failed(self, provider: BaseProvider):
-        self.last_failure[provider.__name__] = time.time()
-        self.current_provider = None
-
-auto_provider = AutoProvider(ACTIVE_PROVIDERS)
+# Routes whose requests get a trace timeline (see tracing.py)
+TRACED_ROUTES = {'/chat/completions', '/v1/direct', '/v1/messages'}
+
+
+@app.before_request
+def begin_trace():
+    tracing.begin(request.path if request.path in TRACED_ROUTES else None)
+
+
+@aio_app.before_request
+async def async_begin_trace():
+    tracing.begin(async_request.path if async_request.path in TRACED_ROUTES else None)
+
+
+@app.after_request
+def end_trace(response):
+    # Streamed responses end their trace in instrument_stream instead
+    if response.mimetype != 'text/event-stream':
+        tracing.finish('ok' if response.status_code < 400 else f'http {response.status_code}')
+    return response
+
+
+@aio_app.after_request
+async def async_end_trace(response):
+    return end_trace(response)
+
+
+def parse_messages(jsong):
+    messages = jsong.get('messages', [])
+
+    # Parse messages if it's a single string containing "System:" and "Human:"
+    if len(messages) == 1 and isinstance(messages[0], str):
+        full_message = messages[0]
+        human_index = full_message.find("Human:")
+        if human_index != -1:
+            system_part = full_message[:human_index].strip()
+            human_part = full_message[human_index + len("Human:"):].strip()
+            if system_part.startswith("System:"):
+                system_content = system_part[len("System:"):].strip()
+            else:
+                system_content = system_part
+            messages = [
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": human_part}
+            ]
+        else:
+            messages = [{"role": "user", "content": full_message}]
+
+    if 'system' in jsong:
+        messages.insert(0, {"role": "system", "content": jsong['system']})
+    tracing.mark('parsed', messages=len(messages))
+    return messages
+
+
+def response_headers(ticket, turn):
+    headers = ticket.headers()
+    if turn is not None:
+        headers.update(turn.headers())
+    return headers
+
+
+class Streamed:
+    # Streaming body a route handler returns instead of (JSON body, status,
+    # headers). Each route has one async handler; its Flask and Quart views
+    # only wrap the result for their framework.
+    def __init__(self, events, mimetype='text/event-stream', headers=None):
+        self.events = events
+        self.mimetype = mimetype
+        self.headers = headers or {}
+
+
+def flask_response(result):
+    if isinstance(result, Streamed):
+        return Response(stream_with_context(iter_sync(result.events)), mimetype=result.mimetype, headers=result.headers)
+    body, status, headers = result
+    return jsonify(body), status, headers
+
+
+def quart_response(result):
+    if isinstance(result, Streamed):
+        return AsyncResponse(result.events, mimetype=result.mimetype, headers=result.headers)
+    body, status, headers = result
+    return async_jsonify(body), status, headers
+
 
 # Define the /chat/completions endpoint
 @app.route('/chat/completions', methods=['POST'])
 def get_request():
+    return flask_response(run_sync(chat_completions(request.json, request.headers)))
+
+
+@aio_app.route('/chat/completions', methods=['POST'])
+async def async_get_request():
+    return quart_response(await chat_completions(await async_request.get_json(), async_request.headers))
+
+
+async def chat_completions(jsong, headers):
     try:
-        jsong = request.json
-        messages = jsong.get('messages', [])
-        model = jsong.get('model', 'gpt-4')
+        turn = sessions.start(jsong)
+        messages = parse_messages(jsong)
+        if turn is not None:
+            messages = turn.with_history(messages)
         stream = jsong.get('stream', False)
-
-        # Parse messages if it's a single string containing "System:" and "Human:"
-        if len(messages) == 1 and isinstance(messages[0], str):
-            full_message = messages[0]
-            human_index = full_message.find("Human:")
-            if human_index != -1:
-                system_part = full_message[:human_index].strip()
-                human_part = full_message[human_index + len("Human:"):].strip()
-                if system_part.startswith("System:"):
-                    system_content = system_part[len("System:"):].strip()
-                else:
-                    system_content = system_part
-                messages = [
-                    {"role": "system", "content": system_content},
-                    {"role": "user", "content": human_part}
-                ]
-            else:
-                messages = [{"role": "user", "content": full_message}]
-        
-        if 'system' in jsong:
-            messages.insert(0, {"role": "system", "content": jsong['system']})
+        key = request_key(messages, jsong, headers)
+        route = router.resolve(jsong.get('model'))
+        deadline = request_deadline(headers)
+        ticket = await admit(headers, key, deadline)
 
         if stream:
-            return Response(stream_with_context(generate_stream(messages)), 
-                          mimetype='text/event-stream')
+            return Streamed(instrument_stream('/chat/completions', ticket.hold_stream(agenerate_stream(messages, key, route, deadline, turn))),
+                            headers=response_headers(ticket, turn))
         else:
-            return jsonify(generate_full_response(messages))
-    
+            response = agenerate_full_response(messages, key, route, deadline, turn, response_model(jsong, route))
+            return await ticket.hold(response), 200, response_headers(ticket, turn)
+
+    except Overloaded as e:
+        return {"error": str(e)}, e.status, e.headers()
+    except SessionNotFound as e:
+        return {"error": str(e)}, 404, {}
     except Exception as e:
         logger.error(f"API Error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-    
+        return {"error": str(e)}, 500, {}
+
+
+def response_model(jsong, route):
+    # Model id reported back: the one the request resolved to, or the one it
+    # asked for (DEFAULT_MODEL if none) when no provider knows it and each
+    # serves its own default
+    return route[0][0] or jsong.get('model') or DEFAULT_MODEL
+
+
+def completion_response(content, messages, model):
+    # Usage counts the prompt actually sent, after context trimming
+    prompt_tokens = message_tokens(messages)
+    completion_tokens = count_tokens(content)
+    return {
+        "id": f"chatcmpl-{uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+
+async def agenerate_stream(messages, key, route, deadline, turn=None):
+    # Closing this generator (Quart does on client disconnect, iter_sync when
+    # the WSGI server closes the response) cancels the upstream call, unless
+    # other identical requests are still reading it. A session `turn` is only
+    # recorded once the whole answer went out.
+    if (text := cached(key)) is not None:
+        for content in replay_chunks(text):
+            yield openai_delta(content)
+        if turn is not None:
+            turn.complete(text)
+        yield OPENAI_DONE
+        return
+
+    parts = []
+    try:
+        messages = await fit_context(messages, route, deadline)
+        async with aclosing(coalesce(shared_text(messages, key, route=route, deadline=deadline))) as contents:
+            async for content in contents:
+                parts.append(content)
+                yield openai_delta(content)
+        if turn is not None:
+            turn.complete(''.join(parts))
+        yield OPENAI_DONE
+    except Exception:
+        yield OPENAI_ERROR
+        yield OPENAI_DONE
+        raise
+
+async def agenerate_full_response(messages, key, route, deadline, turn=None, model=''):
+    with track_request('/chat/completions'):
+        text = cached(key)
+        if text is None:
+            messages = await fit_context(messages, route, deadline)
+            text = await full_text(messages, key, route=route, deadline=deadline)
+        response = completion_response(text, messages, model)
+        if turn is not None:
+            turn.complete(text)
+            response["conversation_id"] = turn.id
+        return response
+
+
+async def batch_completion(jsong, pick, tenant='batch'):
+    # One line of a batch job, spread over providers by `pick`. Lines queue
+    # behind interactive requests for as long as it takes instead of being
+    # turned away.
+    messages = parse_messages(jsong)
+    key = request_key(messages, jsong)
+    route = router.resolve(jsong.get('model'))
+    if (text := cached(key)) is not None:
+        return completion_response(text, messages, response_model(jsong, route))
+    ticket = await scheduler.admit(tenant, BATCH, bounded=False)
+    return await ticket.hold(batch_response(messages, key, pick, route, response_model(jsong, route)))
+
+
+async def batch_response(messages, key, pick, route, model):
+    messages = await fit_context(messages, route)
+    async with aclosing(generate_text(messages, key, stream=False, pick=pick, route=route)) as chunks:
+        content = ''.join([chunk async for chunk in chunks])
+    return completion_response(content, messages, model)
+
+
+# Bulk endpoint: JSONL of /chat/completions bodies in, JSONL results out in
+# completion order. ?checkpoint=<name> makes the job resumable.
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    return flask_response(run_sync(batch_job(request.get_data(as_text=True), request.headers, request.args)))
+
+
+@aio_app.route('/v1/batches', methods=['POST'])
+async def async_create_batch():
+    return quart_response(await batch_job(await async_request.get_data(as_text=True), async_request.headers, async_request.args))
+
+
+async def batch_job(data, headers, args):
+    results = stream_batch(data, partial(batch_completion, tenant=request_tenant(headers)), auto_provider,
+                           args.get('checkpoint'), args.get('concurrency', 0, type=int))
+    return Streamed(results, mimetype='application/x-ndjson')
+
+
+# Anthropic protocol, served from the same provider pool. Claude models no
+# provider serves go to every provider with its own default model.
+def anthropic_route(jsong):
+    return router.resolve(jsong.get('model'), default='')
+
+
+def with_system(jsong):
+    messages = jsong['messages']
+    if 'system' in jsong:
+        messages.insert(0, {
+            "role": "user",
+            "content": jsong['system']
+        })
+    tracing.mark('parsed', messages=len(messages))
+    return messages
+
+
+# Endpoint for direct translation (non-streaming)
+@app.route('/v1/direct', methods=['POST'])
+def direct_translate():
+    return flask_response(run_sync(direct(request.json, request.headers)))
+
+
+@aio_app.route('/v1/direct', methods=['POST'])
+async def async_direct_translate():
+    return quart_response(await direct(await async_request.get_json(), async_request.headers))
+
+
+async def direct(jsong, headers):
+    jsong.setdefault('system', '')
+    document = memory_document(jsong)
+    messages = with_system(jsong)
+    key = request_key(messages, jsong, headers)
+    deadline = request_deadline(headers)
+    try:
+        ticket = await admit(headers, key, deadline)
+    except Overloaded as e:
+        return {"error": str(e)}, e.status, e.headers()
+    body, status = await ticket.hold(translate(messages, key, anthropic_route(jsong), deadline, jsong, document))
+    return body, status, ticket.headers()
+
+
+async def translate(messages, key, route, deadline, jsong=None, document=None):
+    # `document` is the text of a single-message request (see
+    # memory_document), which translation memory or micro-batching can handle
+    with track_request('/v1/direct'):
+        if (text := cached(key)) is not None:
+            return {"translatedText": text}, 200
 
-def generate_stream(messages):
-    retries = 3
-    for attempt in range(retries):
-        provider = auto_provider.get_provider()
-        try:
-            logger.info(f"Trying provider: {provider.__name__}")
-            
-            response = ChatCompletion.create(
-                model=models.gpt_4,
-                messages=messages,
-                stream=True,
-                provider=provider,
-                timeout=30
-            )
-            
-            for chunk in response:
-                content = getattr(chunk, 'content', str(chunk))
-                yield f"data: {dumps({'choices': [{'delta': {'content': content}}]})}\n\n"
-            yield "data: [DONE]\n\n"
-            return
-            
-        except Exception as e:
-            logger.warning(f"Provider {provider.__name__} failed: {str(e)}")
-            auto_provider.mark_failed(provider)
-            if attempt < retries - 1:
-                delay = 2 ** attempt
-                logger.info(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                yield f"data: {dumps({'error': 'All providers failed'})}\n\n"
-                yield "data: [DONE]\n\n"
-                raise
-
-def generate_full_response(messages):
-    retries = 3
-    for attempt in range(retries):
-        provider = auto_provider.get_provider()
         try:
-            logger.info(f"Trying provider: {provider.__name__}")
-            
-            response = ChatCompletion.create(
-                model=models.gpt_4,
-                messages=messages,
-                stream=False,
-                provider=provider,
-                timeout=30
-            )
-            
-            content = getattr(response, 'content', str(response))
-            return {
-                "id": f"chatcmpl-{uuid4().hex}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": "gpt-4",
-                "choices": [{
-                    "index": 0,
-                    "message": {"role": "assistant", "content": content},
-                    "finish_reason": "stop"
-                }],
-                "usage": {"prompt_tokens": 25, "completion_tokens": 15, "total_tokens": 40}
-            }
-            
-        except Exception as e:
-            logger.warning(f"Provider {provider.__name__} failed: {str(e)}")
-            auto_provider.mark_failed(provider)
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-                continue
-            raise
+            if document is not None and memory_enabled(jsong):
+                return {"translatedText": await translate_segments(jsong, document, messages, key, route, deadline)}, 200
+            if short_text(document) and microbatch_enabled(jsong):
+                if (text := await translate_batched(jsong, document, key, route, deadline)) is not None:
+                    return {"translatedText": text}, 200
+            return {"translatedText": await full_text(messages, key, route=route, deadline=deadline)}, 200
+        except Exception:
+            return {"error": "All providers failed"}, 500
+
+
+async def translate_batched(jsong, document, key, route, deadline):
+    # Short requests sharing a system prompt, target language and model go
+    # upstream together (see microbatch.py); None means send it on its own
+    group = memory_context(jsong['system'], jsong.get('target_lang') or jsong.get('target_language') or '',
+                           jsong.get('model') or '')
+
+    async def send(texts, batch_deadline):
+        prompt = batch_messages(jsong['system'], texts)
+        answer = await full_text(prompt, cache_key(prompt, jsong), route=route, deadline=batch_deadline)
+        return parse_batch(answer, len(texts))
+
+    with tracing.span('microbatch') as span:
+        text = await microbatcher.submit(group, document, deadline, send)
+        span['batched'] = text is not None
+    if text is not None and CACHE_ENABLED and key is not None:
+        response_cache.put(key, text)
+    return text
+
+
+async def translate_segments(jsong, document, messages, key, route, deadline):
+    # Known segments come from translation memory; the rest go upstream in
+    # one prompt. If the answer can't be split back into segments, the whole
+    # document is translated as before and nothing is stored.
+    pieces = split_segments(document)
+    context = memory_context(jsong['system'], jsong.get('target_lang') or jsong.get('target_language') or '',
+                             jsong.get('model') or '')
+    sources = list(dict.fromkeys(piece for piece, translatable in pieces if translatable))
+    known = translation_memory.lookup(context, sources)
+    misses = [source for source in sources if source not in known]
+    if misses:
+        prompt = batch_messages(jsong['system'], misses)
+        answer = await full_text(prompt, cache_key(prompt, jsong), route=route, deadline=deadline)
+        translations = parse_batch(answer, len(misses))
+        if translations is None:
+            logger.warning(f"Translation memory: answer for {len(misses)} segments didn't match, translating the whole document")
+            return await full_text(messages, key, route=route, deadline=deadline)
+        translation_memory.store(context, zip(misses, translations))
+        known.update(zip(misses, translations))
+    text = ''.join(known[piece] if translatable else piece for piece, translatable in pieces)
+    if CACHE_ENABLED and key is not None:
+        response_cache.put(key, text)
+    return text
+
+
+# Endpoint for streaming messages
+@app.route('/v1/messages', methods=['POST'])
+def get_messages():
+    return flask_response(run_sync(anthropic_messages(request.json, request.headers)))
+
+
+@aio_app.route('/v1/messages', methods=['POST'])
+async def async_get_messages():
+    return quart_response(await anthropic_messages(await async_request.get_json(), async_request.headers))
+
+
+async def anthropic_messages(jsong, headers):
+    try:
+        messages, pinned, turn = session_messages(jsong)
+    except SessionNotFound as e:
+        return {"error": str(e)}, 404, {}
+    key = request_key(messages, jsong, headers)
+    deadline = request_deadline(headers)
+    try:
+        ticket = await admit(headers, key, deadline)
+    except Overloaded as e:
+        return {"error": str(e)}, e.status, e.headers()
+    route = anthropic_route(jsong)
+    events = stream_messages(messages, key, route, deadline, pinned, turn, response_model(jsong, route))
+    return Streamed(instrument_stream('/v1/messages', ticket.hold_stream(events)), headers=response_headers(ticket, turn))
+
+
+def session_messages(jsong):
+    # (messages, pinned, session turn) of an Anthropic request. with_system
+    # puts the system prompt first as a user message, so it's pinned against
+    # context trimming; in a session only the first turn's counts.
+    turn = sessions.start(jsong)
+    pinned = int('system' in jsong)
+    messages = with_system(jsong)
+    if turn is not None:
+        messages = turn.with_history(messages, pinned)
+        pinned = turn.pinned
+    return messages, pinned, turn
+
+
+async def stream_messages(messages, key, route, deadline, pinned=0, turn=None, model=''):
+    if (text := cached(key)) is not None:
+        yield anthropic_start(model, message_tokens(messages))
+        for message in replay_chunks(text):
+            yield anthropic_delta(message)
+        if turn is not None:
+            turn.complete(text)
+        yield anthropic_stop(count_tokens(text))
+        return
+
+    messages = await fit_context(messages, route, deadline, pinned=pinned)
+    yield anthropic_start(model, message_tokens(messages))
+    parts = []
+    try:
+        async with aclosing(coalesce(shared_text(messages, key, route=route, deadline=deadline))) as contents:
+            async for message in contents:
+                parts.append(message)
+                yield anthropic_delta(message)
+    except Exception:
+        yield OPENAI_ERROR
+        yield OPENAI_DONE
+        return
+    if turn is not None:
+        turn.complete(''.join(parts))
+    yield anthropic_stop(count_tokens(''.join(parts)))
 
 
 @app.route('/models')
 def show_modesl():
+    # Every model id (and alias) some active provider serves, from the router
+    return {"object": "list", "data": router.listing()}
+
+
+@aio_app.route('/models')
+async def async_show_models():
+    return show_modesl()
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    return response_cache.stats()
+
+
+@aio_app.route('/cache/stats')
+async def async_cache_stats():
+    return cache_stats()
+
+
+@app.route('/translation-memory/stats')
+def translation_memory_stats():
+    return translation_memory.stats()
+
+
+@aio_app.route('/translation-memory/stats')
+async def async_translation_memory_stats():
+    return translation_memory_stats()
+
+
+@app.route('/sessions/stats')
+def sessions_stats():
+    return sessions.stats()
+
+
+@aio_app.route('/sessions/stats')
+async def async_sessions_stats():
+    return sessions_stats()
+
+
+@app.route('/upstream/stats')
+def upstream_stats():
+    return pool.stats()
+
+
+@aio_app.route('/upstream/stats')
+async def async_upstream_stats():
+    return upstream_stats()
+
+
+@app.route('/scheduler/stats')
+def scheduler_stats():
+    return scheduler.stats()
+
+
+@aio_app.route('/scheduler/stats')
+async def async_scheduler_stats():
+    return scheduler_stats()
+
+
+# Slowest kept request traces, slowest first: ?n= of them (default 20)
+@app.route('/debug/slow')
+def slow_traces():
+    return jsonify(slow_traces_response(request.args.get('n', 20, type=int)))
+
+
+@aio_app.route('/debug/slow')
+async def async_slow_traces():
+    return async_jsonify(slow_traces_response(async_request.args.get('n', 20, type=int)))
+
+
+def slow_traces_response(count):
     return {
-        "object": "list",
-        "data": [
-            {
-            "id": "gpt-4.5-preview",
-            "object": "model",
-            "created": 1740623059,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4.5-preview-2025-02-27",
-            "object": "model",
-            "created": 1740623304,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-mini-2024-07-18",
-            "object": "model",
-            "created": 1721172717,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-mini-audio-preview-2024-12-17",
-            "object": "model",
-            "created": 1734115920,
-            "owned_by": "system"
-            },
-            {
-            "id": "dall-e-3",
-            "object": "model",
-            "created": 1698785189,
-            "owned_by": "system"
-            },
-            {
-            "id": "dall-e-2",
-            "object": "model",
-            "created": 1698798177,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-audio-preview-2024-10-01",
-            "object": "model",
-            "created": 1727389042,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-audio-preview",
-            "object": "model",
-            "created": 1727460443,
-            "owned_by": "system"
-            },
-            {
-            "id": "o1-mini-2024-09-12",
-            "object": "model",
-            "created": 1725648979,
-            "owned_by": "system"
-            },
-            {
-            "id": "o1-mini",
-            "object": "model",
-            "created": 1725649008,
-            "owned_by": "system"
-            },
-            {
-            "id": "omni-moderation-latest",
-            "object": "model",
-            "created": 1731689265,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-mini-audio-preview",
-            "object": "model",
-            "created": 1734387424,
-            "owned_by": "system"
-            },
-            {
-            "id": "omni-moderation-2024-09-26",
-            "object": "model",
-            "created": 1732734466,
-            "owned_by": "system"
-            },
-            {
-            "id": "babbage-002",
-            "object": "model",
-            "created": 1692634615,
-            "owned_by": "system"
-            },
-            {
-            "id": "tts-1-hd-1106",
-            "object": "model",
-            "created": 1699053533,
-            "owned_by": "system"
-            },
-            {
-            "id": "text-embedding-3-large",
-            "object": "model",
-            "created": 1705953180,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-2024-05-13",
-            "object": "model",
-            "created": 1715368132,
-            "owned_by": "system"
-            },
-            {
-            "id": "tts-1-hd",
-            "object": "model",
-            "created": 1699046015,
-            "owned_by": "system"
-            },
-            {
-            "id": "o1-preview",
-            "object": "model",
-            "created": 1725648897,
-            "owned_by": "system"
-            },
-            {
-            "id": "o1-preview-2024-09-12",
-            "object": "model",
-            "created": 1725648865,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-3.5-turbo-instruct-0914",
-            "object": "model",
-            "created": 1694122472,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-mini-search-preview",
-            "object": "model",
-            "created": 1741391161,
-            "owned_by": "system"
-            },
-            {
-            "id": "tts-1-1106",
-            "object": "model",
-            "created": 1699053241,
-            "owned_by": "system"
-            },
-            {
-            "id": "davinci-002",
-            "object": "model",
-            "created": 1692634301,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-3.5-turbo-1106",
-            "object": "model",
-            "created": 1698959748,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-search-preview",
-            "object": "model",
-            "created": 1741388720,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-3.5-turbo-instruct",
-            "object": "model",
-            "created": 1692901427,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-mini-search-preview-2025-03-11",
-            "object": "model",
-            "created": 1741390858,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-3.5-turbo-0125",
-            "object": "model",
-            "created": 1706048358,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-4o-2024-08-06",
-            "object": "model",
-            "created": 1722814719,
-            "owned_by": "system"
-            },
-            {
-            "id": "gpt-3.5-turbo",
-            "object": "model",
-            "created": 1677610602,
-            "owned_by": "openai"
-            },
-            {
-            "id": "gpt-3.5-turbo-16k",
-            "object": "model",
-            "created": 1683758102,
-            "owned_by": "openai-internal"
-            },
-            {
-            "id": "gpt-4o",
-            "object": "model",
-            "created": 1715367049,
-            "owned_by": "system"
-            },
-            {
-            "id": "text-embedding-3-small",
-            "object": "model",
-            "created": 1705948997,
-            "owned_by": "system"
-            },
-            {
-            "id": "text-embedding-ada-002",
-            "object": "model",
-            "created": 1671217299,
-            "owned_by": "openai-internal"
-            },
-            {
-            "id": "gpt-4o-mini",
-            "object": "model",
-            "created": 1721172741,
-            "owned_by": "system"
-            },
-            {
-            "id": "whisper-1",
-            "object": "model",
-            "created": 1677532384,
-            "owned_by": "openai-internal"
-            },
-            {
-            "id": "gpt-4o-search-preview-2025-03-11",
-            "object": "model",
-            "created": 1741388170,
-            "owned_by": "system"
-            },
-            {
-            "id": "tts-1",
-            "object": "model",
-            "created": 1681940951,
-            "owned_by": "openai-internal"
-            },
-            {
-            "id": "gpt-4o-2024-11-20",
-            "object": "model",
-            "created": 1739331543,
-            "owned_by": "system"
-            }
-        ]
-        }
-
-
-
-asgi = WsgiToAsgi(app)
+        "kept": len(tracing.recorder.traces),
+        "sample_rate": tracing.TRACE_SAMPLE_RATE,
+        "slow_seconds": tracing.TRACE_SLOW_SECONDS,
+        "traces": tracing.recorder.slowest(max(0, count)),
+    }
+
+
+@app.route('/metrics')
+def show_metrics():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+@aio_app.route('/metrics')
+async def async_show_metrics():
+    return AsyncResponse(render(), mimetype='text/plain; version=0.0.4')
+
+
+# Liveness: the process is up and serving requests
+@app.route('/healthz')
+def healthz():
+    return {"status": "ok"}
+
+
+@aio_app.route('/healthz')
+async def async_healthz():
+    return healthz()
+
+
+# Readiness: 503 until warm-up (WARMUP=1) has enough warm providers
+@app.route('/readyz')
+def readyz():
+    status = warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@aio_app.route('/readyz')
+async def async_readyz():
+    status = warmup.status()
+    return async_jsonify(status), 200 if status["ready"] else 503
+
+
+# ASYNC_SERVING=0 falls back to running the Flask views in uvicorn's thread pool
+ASYNC_SERVING = environ.get('ASYNC_SERVING', '1') != '0'
+if ASYNC_SERVING:
+    asgi = aio_app
+else:
+    asgi = WsgiToAsgi(app)
+    auto_provider.start_health_checks(get_loop())
+    warmup.start(get_loop())
+
+
+@aio_app.before_serving
+async def start_health_checks():
+    auto_provider.start_health_checks()
+    warmup.start()
+
+
+@aio_app.after_serving
+async def close_upstream():
+    await pool.close()
+
 
 if __name__ == '__main__':
+    auto_provider.start_health_checks(get_loop())
+    warmup.start(get_loop())
     app.run(host='0.0.0.0', port=5000)
 # uvicorn app:asgi_app --host 0.0.0.0 --port 5000
@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import json
+import logging
+import re
+from collections import defaultdict
+from os import environ, makedirs, path
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple
+
+from providers import AutoProvider
+
+logger = logging.getLogger(__name__)
+
+# Concurrent requests per healthy provider; the batch-wide limit scales with it
+BATCH_PER_PROVIDER = int(environ.get('BATCH_PER_PROVIDER', '4'))
+# Where /v1/batches keeps checkpoints of named jobs
+BATCH_DIR = environ.get('BATCH_DIR', 'batches')
+
+
+class ProviderSpread:
+    # Spreads batch requests over every healthy provider by sending each one
+    # to the provider with the fewest batch requests in flight, instead of
+    # sending everything to the best-scoring provider.
+    def __init__(self, auto_provider: AutoProvider):
+        self.auto_provider = auto_provider
+        self.load: Dict[str, int] = defaultdict(int)
+
+    def picker(self) -> 'SpreadPicker':
+        return SpreadPicker(self)
+
+
+class SpreadPicker:
+    # Provider choice for one batch item across its retries
+    def __init__(self, spread: ProviderSpread):
+        self.spread = spread
+        self.current = None
+
+    def __call__(self, exclude=()):
+        self.release()
+        candidates = self.spread.auto_provider.ranked(exclude)
+        if not candidates:
+            raise Exception("All providers are temporarily unavailable")
+        # min() keeps the best-ranked provider among equally loaded ones
+        provider = min(candidates, key=lambda p: self.spread.load[p.__name__])
+        self.spread.auto_provider.claim(provider)
+        self.spread.load[provider.__name__] += 1
+        self.current = provider
+        return provider
+
+    def release(self):
+        if self.current is not None:
+            self.spread.load[self.current.__name__] -= 1
+            self.current = None
+
+
+def parse_lines(lines: Iterable[str]) -> List[Tuple[int, object]]:
+    # (index, request) pairs; unparseable lines become the exception
+    items = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            items.append((len(items), json.loads(line)))
+        except ValueError as e:
+            items.append((len(items), e))
+    return items
+
+
+def load_checkpoint(lines: Iterable[str]) -> Dict[int, dict]:
+    # Results that completed successfully; failed ones are retried on resume
+    done = {}
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue  # torn last line of an interrupted run
+        if 'error' not in result:
+            done[result['index']] = result
+    return done
+
+
+def default_concurrency(auto_provider: AutoProvider) -> int:
+    return BATCH_PER_PROVIDER * max(1, len(auto_provider.available()))
+
+
+async def run_batch(items: List[Tuple[int, object]], handle: Callable[[dict, SpreadPicker], Awaitable[dict]],
+                    auto_provider: AutoProvider, concurrency: int = 0):
+    # Runs `handle` over the items with bounded concurrency and yields result
+    # dicts in completion order
+    spread = ProviderSpread(auto_provider)
+    pending = asyncio.Queue()
+    for item in items:
+        pending.put_nowait(item)
+    results = asyncio.Queue()
+
+    async def worker():
+        while not pending.empty():
+            index, jsong = pending.get_nowait()
+            result = {"index": index}
+            if isinstance(jsong, dict) and 'custom_id' in jsong:
+                result["custom_id"] = jsong['custom_id']
+            picker = spread.picker()
+            try:
+                if not isinstance(jsong, dict):
+                    raise ValueError(f"Invalid request line: {jsong}")
+                result["response"] = await handle(jsong, picker)
+            except Exception as e:
+                result["error"] = str(e)
+            finally:
+                picker.release()
+            await results.put(result)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(len(items), concurrency or default_concurrency(auto_provider)))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def checkpoint_path(name: str) -> str:
+    return path.join(BATCH_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.jsonl')
+
+
+def open_checkpoint(filename: str):
+    # Finished results from an earlier run, and the file opened for appending
+    done = {}
+    torn = False
+    if path.exists(filename):
+        with open(filename, encoding='utf-8') as f:
+            content = f.read()
+        done = load_checkpoint(content.splitlines())
+        torn = bool(content) and not content.endswith('\n')
+    output = open(filename, 'a', encoding='utf-8')
+    if torn:
+        output.write('\n')
+    return done, output
+
+
+async def stream_batch(body: str, handle, auto_provider: AutoProvider, checkpoint: str = None, concurrency: int = 0):
+    # JSONL lines for /v1/batches. A named checkpoint replays the results a
+    # previous run already finished and only sends the rest upstream.
+    items = parse_lines(body.splitlines())
+    done = {}
+    output = None
+    if checkpoint:
+        makedirs(BATCH_DIR, exist_ok=True)
+        done, output = open_checkpoint(checkpoint_path(checkpoint))
+    try:
+        for result in done.values():
+            yield json.dumps(result) + '\n'
+        async for result in run_batch([item for item in items if item[0] not in done], handle, auto_provider, concurrency):
+            line = json.dumps(result) + '\n'
+            if output:
+                output.write(line)
+                output.flush()
+            yield line
+    finally:
+        if output:
+            output.close()
+
+
+async def main(args):
+    from app import auto_provider, batch_completion
+
+    with open(args.input, encoding='utf-8') as f:
+        items = parse_lines(f)
+    done, output = open_checkpoint(args.output)
+    if done:
+        logger.info(f"Resuming: {len(done)} of {len(items)} requests already done")
+
+    remaining = [item for item in items if item[0] not in done]
+    failed = 0
+    with output:
+        async for result in run_batch(remaining, batch_completion, auto_provider, args.concurrency):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            failed += 'error' in result
+    logger.info(f"Finished {len(remaining)} requests, {failed} failed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a JSONL file of chat requests across all healthy providers")
+    parser.add_argument('input', help="JSONL file, one /chat/completions request body per line")
+    parser.add_argument('output', help="JSONL results in completion order; an existing file is resumed")
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help=f"Requests in flight (default: {BATCH_PER_PROVIDER} per healthy provider)")
+    asyncio.run(main(parser.parse_args()))
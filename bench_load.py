@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import json
+import re
+import socket
+import subprocess
+import sys
+import time
+from os import environ
+from uuid import uuid4
+
+import aiohttp
+
+# Load test for the gateway routes: drives each route at several concurrency
+# levels and reports throughput, TTFT and total latency percentiles, errors
+# and server CPU per request (from process_cpu_seconds_total on /metrics).
+# --serve starts `uvicorn app:asgi` against mock providers (mock_provider.py),
+# so runs are repeatable and need no live upstreams.
+
+DEFAULT_MOCK_PROVIDERS = 'mock_a:ttft=0.2,tps=100;mock_b:ttft=0.4,tps=50;mock_c:ttft=0.3,tps=80,error_rate=0.05'
+
+# First bytes of an event carrying answer text, per protocol
+TEXT_MARKERS = (b'{"content": ', b'"text_delta"')
+
+
+def openai_body(content, stream):
+    return {"model": "gpt-4", "messages": [{"role": "user", "content": content}], "stream": stream}
+
+
+def anthropic_body(content, stream):
+    return {"model": "claude-3-5-sonnet-20241022", "messages": [{"role": "user", "content": content}],
+            "system": "You are a benchmark.", "stream": stream}
+
+
+ROUTES = {
+    'chat_stream': ('/chat/completions', lambda content: openai_body(content, True), True),
+    'chat': ('/chat/completions', lambda content: openai_body(content, False), False),
+    'messages': ('/v1/messages', lambda content: anthropic_body(content, True), True),
+    'direct': ('/v1/direct', lambda content: anthropic_body(content, False), False),
+}
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def server_cpu(session, url):
+    async with session.get(f"{url}/metrics") as response:
+        text = await response.text()
+    match = re.search(r'^process_cpu_seconds_total (\S+)$', text, re.M)
+    return float(match.group(1)) if match else None
+
+
+async def one_request(session, url, route, unique):
+    path, make_body, streaming = ROUTES[route]
+    content = f"Benchmark prompt {uuid4().hex if unique else ''}"
+    start = time.perf_counter()
+    ttft = None
+    error = False
+    try:
+        async with session.post(url + path, json=make_body(content)) as response:
+            error = response.status != 200
+            if streaming:
+                async for data in response.content.iter_any():
+                    if ttft is None and any(marker in data for marker in TEXT_MARKERS):
+                        ttft = time.perf_counter() - start
+                    error = error or b'"error"' in data
+            else:
+                error = error or 'error' in await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        error = True
+    total = time.perf_counter() - start
+    return (ttft if ttft is not None else total), total, error
+
+
+async def run_level(session, url, route, concurrency, requests, unique):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            return await one_request(session, url, route, unique)
+
+    cpu_before = await server_cpu(session, url)
+    start = time.perf_counter()
+    results = await asyncio.gather(*[limited() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+    cpu_after = await server_cpu(session, url)
+
+    ok = [result for result in results if not result[2]]
+    ttfts = [result[0] for result in ok]
+    totals = [result[1] for result in ok]
+    cpu = (cpu_after - cpu_before) / requests if cpu_before is not None and cpu_after is not None else None
+    return {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - len(ok),
+        "throughput": len(ok) / elapsed,
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "ttft_p99": percentile(ttfts, 99),
+        "total_p50": percentile(totals, 50),
+        "total_p95": percentile(totals, 95),
+        "total_p99": percentile(totals, 99),
+        "cpu_ms_per_request": cpu * 1000 if cpu is not None else None,
+    }
+
+
+def print_result(result):
+    cpu = result['cpu_ms_per_request']
+    print(f"{result['route']:12} c={result['concurrency']:<4} {result['throughput']:8.1f} req/s  "
+          f"ttft p50/p95/p99 {result['ttft_p50'] * 1000:6.0f}/{result['ttft_p95'] * 1000:6.0f}/{result['ttft_p99'] * 1000:6.0f} ms  "
+          f"total p50/p95/p99 {result['total_p50'] * 1000:6.0f}/{result['total_p95'] * 1000:6.0f}/{result['total_p99'] * 1000:6.0f} ms  "
+          f"cpu {cpu if cpu is None else f'{cpu:.2f}'} ms/req  errors {result['errors']}", flush=True)
+
+
+def start_server(args):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    env = dict(environ)
+    env.setdefault('MOCK_PROVIDERS', DEFAULT_MOCK_PROVIDERS)
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app:asgi', '--port', str(port), '--log-level', 'warning'],
+                               env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def wait_ready(session, url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{url}/metrics") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+async def main(args):
+    process = None
+    url = args.url.rstrip('/')
+    if args.serve:
+        process, url = start_server(args)
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    results = []
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await wait_ready(session, url)
+            for route in args.routes.split(','):
+                for concurrency in map(int, args.concurrency.split(',')):
+                    result = await run_level(session, url, route, concurrency, args.requests or concurrency * 10,
+                                             not args.repeat)
+                    print_result(result)
+                    results.append(result)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load-test the gateway routes")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Server to test (ignored with --serve)")
+    parser.add_argument('--serve', action='store_true',
+                        help="Start uvicorn app:asgi with MOCK_PROVIDERS (a default mock pool if unset)")
+    parser.add_argument('--routes', default=','.join(ROUTES), help=f"Comma-separated subset of {', '.join(ROUTES)}")
+    parser.add_argument('--concurrency', default='1,8,32', help="Comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=0, help="Requests per level (default: 10 x concurrency)")
+    parser.add_argument('--repeat', action='store_true',
+                        help="Send the same prompt every time, exercising the cache and single-flight")
+    parser.add_argument('--timeout', type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument('--output', help="Write the results as JSON, for comparing runs")
+    parser.add_argument('--verbose', action='store_true', help="Show the server's log with --serve")
+    asyncio.run(main(parser.parse_args()))
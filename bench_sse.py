@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import time
+import timeit
+from json import dumps
+
+from sse import anthropic_delta, coalesce, openai_delta
+
+# Micro-benchmark of SSE event encoding: the per-chunk json.dumps + f-string
+# formatting used before against the pre-encoded frames in sse.py, plus the
+# number of events written with coalescing at a few settings.
+
+SAMPLES = ['Hello', ' world', ',', ' "quoted"', ' line\nbreak', ' café', ' 你好', ' the']
+
+
+def openai_dumps(text):
+    return f"data: {dumps({'choices': [{'delta': {'content': text}}]})}\n\n".encode('utf-8')
+
+
+def anthropic_dumps(text):
+    return f"event: content_block_delta\ndata: {dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}})}\n\n".encode('utf-8')
+
+
+def bench_encoding(number):
+    for old, new in ((openai_dumps, openai_delta), (anthropic_dumps, anthropic_delta)):
+        for text in SAMPLES:
+            assert old(text) == new(text), text
+        before = min(timeit.repeat(lambda: [old(text) for text in SAMPLES], number=number, repeat=5))
+        after = min(timeit.repeat(lambda: [new(text) for text in SAMPLES], number=number, repeat=5))
+        per_event = 1e9 / (number * len(SAMPLES))
+        print(f"{new.__name__:16} dumps {before * per_event:7.0f} ns/event   pre-encoded {after * per_event:7.0f} ns/event"
+              f"   {before / after:.1f}x")
+
+
+async def tokens(count, gap):
+    for i in range(count):
+        if gap:
+            await asyncio.sleep(gap)
+        yield SAMPLES[i % len(SAMPLES)]
+
+
+async def bench_coalescing(count, gap):
+    for max_chars, interval in ((0, 0), (64, 0), (0, 0.02), (256, 0.02)):
+        start = time.perf_counter()
+        events = size = 0
+        async for text in coalesce(tokens(count, gap), max_chars, interval):
+            event = openai_delta(text)
+            events += 1
+            size += len(event)
+        elapsed = time.perf_counter() - start
+        print(f"coalesce max_chars={max_chars:<4} interval={interval:<5} {events:6} events {size:8} bytes  {elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark SSE event encoding and coalescing")
+    parser.add_argument('--number', type=int, default=20000, help="Encoding loops per timing run")
+    parser.add_argument('--tokens', type=int, default=500, help="Chunks per simulated stream")
+    parser.add_argument('--gap', type=float, default=0.002, help="Seconds between simulated chunks")
+    args = parser.parse_args()
+    bench_encoding(args.number)
+    asyncio.run(bench_coalescing(args.tokens, args.gap))
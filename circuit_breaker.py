@@ -0,0 +1,129 @@
+from collections import deque
+from os import environ
+from typing import Optional
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Sliding window the failure rate is computed over, in seconds
+BREAKER_WINDOW = float(environ.get('BREAKER_WINDOW', '60'))
+BREAKER_FAILURE_RATE = float(environ.get('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_MIN_REQUESTS = int(environ.get('BREAKER_MIN_REQUESTS', '3'))
+# First open period; doubles each time the breaker re-opens, up to the maximum
+BREAKER_OPEN_SECONDS = float(environ.get('BREAKER_OPEN_SECONDS', '10'))
+BREAKER_MAX_OPEN_SECONDS = float(environ.get('BREAKER_MAX_OPEN_SECONDS', '600'))
+# A half-open probe that never reports back frees its slot after this long
+PROBE_TIMEOUT = 60
+
+TIMEOUT_ERRORS = {'TimeoutError', 'ReadTimeout', 'ConnectTimeout', 'ServerTimeoutError', 'Timeout'}
+THROTTLE_ERRORS = {'RateLimitError', 'CloudflareError', 'ConversationLimitError'}
+FATAL_ERRORS = {'MissingAuthError', 'PaymentRequiredError', 'ProviderNotWorkingError',
+                'MissingRequirementsError', 'NoValidHarFileError'}
+
+
+def classify(error: Optional[BaseException]) -> str:
+    # Matched by class name so it works across g4f versions
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if names & TIMEOUT_ERRORS:
+        return 'timeout'
+    if names & THROTTLE_ERRORS or '429' in str(error):
+        return 'throttled'
+    if names & FATAL_ERRORS:
+        return 'fatal'
+    return 'error'
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.events = deque()  # (time, succeeded)
+        self.open_until = 0.0
+        self.opened = 0  # consecutive opens, drives the exponential open period
+        self.probe_started = None
+        self.last_error = None
+
+    def available(self, now: float, background_probe: bool = False) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            # With a background prober, recovery is never tested on user traffic
+            return now >= self.open_until and not background_probe
+        return self.probe_started is None or now - self.probe_started > PROBE_TIMEOUT
+
+    def acquire(self, now: float):
+        # Called when a request is actually routed here
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+            self.probe_started = None
+        if self.state == HALF_OPEN:
+            self.probe_started = now
+
+    def release(self):
+        # The request ended without telling us anything about health
+        self.probe_started = None
+
+    def record_success(self, now: float):
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.events.clear()
+            self.opened = 0
+            self.probe_started = None
+        self._add(now, True)
+
+    def record_failure(self, now: float, error: Optional[BaseException] = None):
+        kind = classify(error) if error is not None else 'error'
+        self.last_error = kind
+        if self.state == HALF_OPEN:
+            self.trip(now, kind)
+            return
+        if self.state == OPEN:
+            return
+        self._add(now, False)
+        if kind in ('throttled', 'fatal'):
+            self.trip(now, kind)
+            return
+        failures = sum(1 for _, succeeded in self.events if not succeeded)
+        if len(self.events) >= BREAKER_MIN_REQUESTS and failures / len(self.events) >= BREAKER_FAILURE_RATE:
+            self.trip(now, kind)
+
+    def trip(self, now: float, kind: str = 'error'):
+        if kind == 'fatal':
+            duration = BREAKER_MAX_OPEN_SECONDS
+        else:
+            duration = min(BREAKER_OPEN_SECONDS * 2 ** self.opened, BREAKER_MAX_OPEN_SECONDS)
+        self.state = OPEN
+        self.open_until = now + duration
+        self.opened += 1
+        self.probe_started = None
+
+    def _add(self, now: float, succeeded: bool):
+        self.events.append((now, succeeded))
+        while self.events and self.events[0][0] < now - BREAKER_WINDOW:
+            self.events.popleft()
+
+    def dump(self) -> dict:
+        return {
+            "state": self.state,
+            "events": list(self.events),
+            "open_until": self.open_until,
+            "opened": self.opened,
+            "probe_started": self.probe_started,
+            "last_error": self.last_error,
+        }
+
+    def load(self, state: dict):
+        self.state = state["state"]
+        self.events = deque(tuple(event) for event in state["events"])
+        self.open_until = state["open_until"]
+        self.opened = state["opened"]
+        self.probe_started = state["probe_started"]
+        self.last_error = state["last_error"]
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "state": self.state,
+            "open_for": max(0.0, self.open_until - now) if self.state == OPEN else 0.0,
+            "opened": self.opened,
+            "last_error": self.last_error,
+        }
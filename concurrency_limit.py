@@ -0,0 +1,90 @@
+from collections import deque
+from os import environ
+from typing import Optional
+
+# Per-provider concurrency limits discovered at runtime. Providers throttle at
+# different, unpublished levels; each limit grows by about one per round of
+# requests served at full use (additive increase) and shrinks on failures
+# (multiplicative decrease) or when the time to first chunk climbs well above
+# the provider's usual (latency gradient), so we back off before the provider
+# starts refusing. Limits are per worker process; like TCP flows, AIMD limits
+# in several workers settle on a fair share of the provider's capacity.
+# ADAPTIVE_LIMITS=0 disables them.
+ADAPTIVE_LIMITS = environ.get('ADAPTIVE_LIMITS', '1') != '0'
+LIMIT_INITIAL = float(environ.get('LIMIT_INITIAL', '8'))
+LIMIT_MIN = float(environ.get('LIMIT_MIN', '1'))
+LIMIT_MAX = float(environ.get('LIMIT_MAX', '64'))
+# Factor applied to the limit on a failure
+LIMIT_BACKOFF = float(environ.get('LIMIT_BACKOFF', '0.5'))
+# TTFT above this multiple of the long-run average counts as congestion
+LIMIT_LATENCY_TOLERANCE = float(environ.get('LIMIT_LATENCY_TOLERANCE', '2'))
+# Factor applied to the limit on a congested success
+LATENCY_BACKOFF = 0.9
+# Weight of a new sample in the long-run TTFT average
+BASELINE_ALPHA = 0.05
+# Cuts this close together (or within one baseline TTFT) count as one
+# congestion event, like one TCP loss window: the requests in flight when a
+# provider is overloaded all fail at about the same time
+DECREASE_INTERVAL = 1.0
+# A request that never reports back frees its slot after this long
+STALE_SECONDS = 300
+
+
+class AdaptiveLimit:
+    def __init__(self, initial: float = LIMIT_INITIAL, enabled: bool = ADAPTIVE_LIMITS):
+        self.enabled = enabled
+        self.limit = initial
+        self.in_flight = deque()  # start times, oldest first
+        self.baseline = None
+        self.last_decrease = None
+
+    def _expire(self, now: float):
+        while self.in_flight and self.in_flight[0] < now - STALE_SECONDS:
+            self.in_flight.popleft()
+
+    def full(self, now: float) -> bool:
+        self._expire(now)
+        return self.enabled and len(self.in_flight) >= int(self.limit)
+
+    def acquire(self, now: float):
+        self.in_flight.append(now)
+
+    def release(self, now: float):
+        # The request ended without telling us anything about the limit
+        self._expire(now)
+        if self.in_flight:
+            self.in_flight.popleft()
+
+    def record_success(self, now: float, ttft: float):
+        # Grow only when the limit was actually in use, so a quiet provider's
+        # limit doesn't drift up untested
+        busy = len(self.in_flight) >= self.limit / 2
+        self.release(now)
+        if self.baseline is not None and ttft > self.baseline * LIMIT_LATENCY_TOLERANCE:
+            self._decrease(now, LATENCY_BACKOFF)
+        elif busy:
+            self.limit = min(LIMIT_MAX, self.limit + 1 / self.limit)
+        self.baseline = ttft if self.baseline is None else self.baseline + BASELINE_ALPHA * (ttft - self.baseline)
+
+    def record_failure(self, now: float, kind: Optional[str] = None):
+        # Fatal errors say nothing about load; the circuit breaker handles
+        # them. Timeouts on a client's own deadline never get here: those
+        # requests only release their slot.
+        self.release(now)
+        if kind != 'fatal':
+            self._decrease(now, LIMIT_BACKOFF)
+
+    def _decrease(self, now: float, factor: float):
+        # Once per congestion event
+        if self.last_decrease is not None and now - self.last_decrease < max(DECREASE_INTERVAL, self.baseline or 0):
+            return
+        self.limit = max(LIMIT_MIN, self.limit * factor)
+        self.last_decrease = now
+
+    def to_dict(self, now: float) -> dict:
+        self._expire(now)
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": len(self.in_flight),
+            "baseline_ttft": self.baseline,
+        }
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import logging
+import re
+from os import environ
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import Counter
+from response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Prompt budget in tokens before dispatch. Longer conversations keep their
+# system prompt and most recent turns; older turns are replaced by a summary
+# that is cached per conversation and extended as turns fall out of the
+# window. Off by default: CONTEXT_BUDGET=0 sends the full history. Without
+# tiktoken installed, token counts are estimates that err on the high side.
+CONTEXT_BUDGET = int(environ.get('CONTEXT_BUDGET', '0'))
+# Per-model budgets, e.g. "gpt-4:8000,gpt-4o:100000"
+MODEL_CONTEXT_BUDGETS = environ.get('MODEL_CONTEXT_BUDGETS', '')
+# Share of the budget the recent turns get when the window moves, so the
+# summary is only extended every so often rather than on each turn
+RECENT_SHARE = float(environ.get('CONTEXT_RECENT_SHARE', '0.5'))
+SUMMARY_WORDS = int(environ.get('SUMMARY_WORDS', '300'))
+SUMMARY_TTL = float(environ.get('SUMMARY_TTL', str(7 * 24 * 3600)))
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD = 4
+# Without tiktoken: short ASCII words, digit groups, and every other
+# character count as a token, which errs on the high side
+TOKEN_PATTERN = re.compile(r'[A-Za-z]{1,6}|\d{1,3}|[^\sA-Za-z\d]')
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for an assistant that will continue it without seeing it. "
+    "Keep facts, decisions, names, numbers, code identifiers and open questions; leave out pleasantries. "
+    f"Answer with the summary only, in at most {SUMMARY_WORDS} words."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+TRIMMED = Counter('gpt_context_trimmed_total', 'Requests whose history was cut to the context budget', ('summary',))
+
+_encoding = None
+
+
+def _encoder():
+    # tiktoken's encoding, or None to use TOKEN_PATTERN. Loading it may need
+    # a download, so a failure falls back for the life of the process.
+    global _encoding
+    if _encoding is None:
+        _encoding = False
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                logger.warning(f"tiktoken encoding unavailable, estimating tokens: {str(e)}")
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoder()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def message_text(message) -> str:
+    # Content as text, including the text parts of multimodal content
+    content = message.get('content', '') if isinstance(message, dict) else message
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return '\n'.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return str(content or '')
+
+
+def message_tokens(messages: List) -> int:
+    return sum(count_tokens(message_text(message)) + MESSAGE_OVERHEAD for message in messages)
+
+
+def parse_budgets(spec: str) -> Dict[str, int]:
+    budgets = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        model, _, tokens = entry.rpartition(':')
+        try:
+            budgets[model] = int(tokens)
+        except ValueError:
+            logger.warning(f"Ignoring context budget {entry!r}")
+    return budgets
+
+
+def pinned_count(messages: List) -> int:
+    # Leading system messages are always kept
+    count = 0
+    while count < len(messages) and isinstance(messages[count], dict) and messages[count].get('role') == 'system':
+        count += 1
+    return count
+
+
+def _digest(messages: List) -> str:
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def transcript(messages: List) -> str:
+    return '\n\n'.join(f"{message.get('role', 'user') if isinstance(message, dict) else 'user'}: {message_text(message)}"
+                       for message in messages)
+
+
+def summary_messages(summary: Optional[str], messages: List) -> List[dict]:
+    if summary:
+        body = f"Summary of the conversation so far:\n{summary}\n\nConversation since then:\n{transcript(messages)}"
+        instructions = SUMMARY_PROMPT + " Merge the summary so far and the new turns into one updated summary."
+    else:
+        body = f"Conversation:\n{transcript(messages)}"
+        instructions = SUMMARY_PROMPT
+    return [{"role": "user", "content": f"{instructions}\n\n{body}"}]
+
+
+class ContextBudget:
+    def __init__(self, default: int = CONTEXT_BUDGET, budgets: Dict[str, int] = None):
+        self.default = default
+        self.budgets = parse_budgets(MODEL_CONTEXT_BUDGETS) if budgets is None else budgets
+        # conversation id -> {"count": messages summarized, "digest": of those, "summary": text}
+        self.summaries = ResponseCache(ttl=SUMMARY_TTL)
+
+    def budget(self, model: str) -> int:
+        return self.budgets.get(model, self.default)
+
+    def conversation_id(self, messages: List, pinned: int) -> str:
+        # A conversation is identified by its pinned messages and first turn
+        return 'summary:' + _digest(messages[:pinned + 1])
+
+    async def fit(self, messages: List, model: str, summarize: Callable[[List[dict]], Awaitable[str]],
+                  pinned: Optional[int] = None) -> List:
+        # `messages` cut to the model's budget. `summarize` sends a prompt
+        # upstream and returns the answer.
+        budget = self.budget(model)
+        if budget <= 0 or message_tokens(messages) <= budget:
+            return messages
+        pinned = pinned_count(messages) if pinned is None else pinned
+        head, turns = messages[:pinned], messages[pinned:]
+        if len(turns) < 2:
+            return messages
+        conversation = self.conversation_id(messages, pinned)
+
+        # The cached summary still applies while the turns after it fit
+        count, summary = self.cached_summary(conversation, turns)
+        if summary is not None and self.fits(head, summary, turns[count:], budget):
+            TRIMMED.inc(('cached',))
+            return self.assemble(head, summary, turns[count:])
+
+        # Move the window: the newest turns filling RECENT_SHARE of what's left
+        # stay, and everything before them is summarized into the summary
+        reserve = min(SUMMARY_WORDS * 2, budget // 4) + count_tokens(SUMMARY_PREFIX)
+        available = budget - message_tokens(head) - reserve
+        start = self.window_start(turns, max(0, int(available * RECENT_SHARE)), count)
+        try:
+            summary = await self.extend(summary, turns[count:start], budget - reserve, summarize)
+        except Exception as e:
+            # Better a truncated history than a failed request
+            logger.warning(f"Summarizing conversation failed, dropping {start - count} older turns: {str(e) or type(e).__name__}")
+            TRIMMED.inc(('failed',))
+            return self.assemble(head, summary, turns[start:])
+        self.summaries.put(conversation, json.dumps({"count": start, "digest": _digest(turns[:start]), "summary": summary}))
+        TRIMMED.inc(('updated',))
+        return self.assemble(head, summary, turns[start:])
+
+    def cached_summary(self, conversation: str, turns: List) -> Tuple[int, Optional[str]]:
+        # (turns covered, summary) if the history it covers is unchanged
+        entry = self.summaries.get(conversation)
+        if entry is not None:
+            entry = json.loads(entry)
+            if entry["count"] <= len(turns) and entry["digest"] == _digest(turns[:entry["count"]]):
+                return entry["count"], entry["summary"]
+        return 0, None
+
+    def fits(self, head: List, summary: Optional[str], recent: List, budget: int) -> bool:
+        return message_tokens(self.assemble(head, summary, recent)) <= budget
+
+    def window_start(self, turns: List, tokens: int, minimum: int) -> int:
+        # Index of the oldest turn kept; the last turn is always kept, and
+        # the kept turns start with a user message where possible
+        start = len(turns) - 1
+        used = message_tokens(turns[start:])
+        while start > minimum and used + message_tokens(turns[start - 1:start]) <= tokens:
+            start -= 1
+            used += message_tokens(turns[start:start + 1])
+        while start < len(turns) - 1 and isinstance(turns[start], dict) and turns[start].get('role') == 'assistant':
+            start += 1
+        return max(start, minimum)
+
+    async def extend(self, summary: Optional[str], turns: List, available: int, summarize) -> Optional[str]:
+        # Folds `turns` into the summary, in pieces of up to `available` tokens
+        while turns:
+            size = 1
+            used = message_tokens(turns[:1])
+            while size < len(turns) and used + message_tokens(turns[size:size + 1]) <= available:
+                used += message_tokens(turns[size:size + 1])
+                size += 1
+            summary = (await summarize(summary_messages(summary, turns[:size]))).strip() or summary
+            turns = turns[size:]
+        return summary
+
+    def assemble(self, head: List, summary: Optional[str], recent: List) -> List:
+        if not summary:
+            return head + recent
+        return head + [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent
@@ -0,0 +1,266 @@
+from g4f.cookies import read_cookie_files, set_cookies_dir
+from shutil import rmtree
+from os import environ, makedirs, path
+import asyncio
+import atexit
+import time
+import logging
+from contextlib import aclosing
+
+from aio import backoff, complete, stream_chunks
+from circuit_breaker import classify
+from context_budget import ContextBudget
+from failover import continuation_messages, splice
+from hedging import HedgedStream, hedging_enabled
+from microbatch import MicroBatcher
+from mock_provider import MOCK_PROVIDERS, mock_providers
+from providers import AutoProvider
+from response_cache import CACHE_ENABLED, ResponseCache, cache_key
+from routing import DEFAULT_MODEL, ModelRouter, load_config
+from scheduler import Ticket, request_priority, request_tenant, scheduler
+from sessions import SessionStore
+from singleflight import SingleFlight
+from translation_memory import TranslationMemory
+from upstream import pool
+import tracing
+from metrics import PROVIDER_RETRIES, Collected
+from warmup import Warmup, load_providers
+
+# Provider pool, retry engine and generation pipeline shared by every protocol
+# the gateway serves. The routes in app.py only translate requests and
+# responses, so a provider failure seen through one protocol moves the other
+# protocols' traffic away from it as well.
+
+logger = logging.getLogger(__name__)
+
+# Keeps g4f's cookies and HAR files in this directory across restarts, so a
+# new process doesn't redo every provider's session setup
+COOKIES_DIR = environ.get('COOKIES_DIR', '')
+if COOKIES_DIR:
+    makedirs(COOKIES_DIR, exist_ok=True)
+    set_cookies_dir(COOKIES_DIR)
+    read_cookie_files(COOKIES_DIR)
+
+# Cleanup function for cookies directory
+@atexit.register
+def remove_cookie():
+    if COOKIES_DIR:
+        return
+    if path.exists(cookie := 'har_and_cookies'):
+        rmtree(cookie)
+
+# Configure providers by name; PROVIDERS=Name,Name,... overrides the list and
+# MOCK_PROVIDERS swaps in local fakes for benchmarks
+DEFAULT_PROVIDERS = [
+    'Copilot',
+    'Yqcloud',
+    'ChatGptEs',
+    'PollinationsAI',
+    'Glider',
+    'Liaobots',
+    'Phind',
+]
+if MOCK_PROVIDERS:
+    ACTIVE_PROVIDERS = mock_providers(MOCK_PROVIDERS)
+else:
+    ACTIVE_PROVIDERS = load_providers(environ.get('PROVIDERS', ','.join(DEFAULT_PROVIDERS)).split(','))
+
+auto_provider = AutoProvider(ACTIVE_PROVIDERS)
+warmup = Warmup(auto_provider)
+
+# Time budget of a request in seconds, unless the client sends its own in an
+# X-Request-Timeout header. Attempts are cut short to fit in it, and retries
+# that couldn't get MIN_ATTEMPT_SECONDS of it are skipped.
+REQUEST_TIMEOUT = float(environ.get('REQUEST_TIMEOUT', '120'))
+MIN_ATTEMPT_SECONDS = float(environ.get('MIN_ATTEMPT_SECONDS', '3'))
+# Upstream timeout of a single attempt
+PROVIDER_TIMEOUT = 30
+router = ModelRouter(ACTIVE_PROVIDERS, load_config())
+response_cache = ResponseCache()
+translation_memory = TranslationMemory()
+context_budget = ContextBudget()
+sessions = SessionStore()
+microbatcher = MicroBatcher()
+flights = SingleFlight()
+
+
+def request_deadline(headers) -> float:
+    # Monotonic time by which the request must be answered
+    try:
+        budget = float(headers.get('X-Request-Timeout', REQUEST_TIMEOUT))
+    except (TypeError, ValueError):
+        budget = REQUEST_TIMEOUT
+    return time.monotonic() + max(0.0, budget)
+
+
+def open_stream(messages, model, timeout=PROVIDER_TIMEOUT):
+    # The attempt's streams (a hedge's backup included) are cut off after
+    # `timeout` on our side too, as many providers ignore the timeout argument
+    deadline = time.monotonic() + timeout
+    return lambda provider: auto_provider.track(provider, stream_chunks(provider, messages, model=model, timeout=timeout), deadline)
+
+
+async def pick_route(pick, route, tried, deadline):
+    # First model in the route's fallback chain with a provider left to try
+    # that is below its concurrency limit. When every one left is at its
+    # limit, waits for a slot rather than pushing a provider past it.
+    # Also returns the providers excluded for it, which hedging must skip too.
+    while True:
+        saturated = False
+        for model, providers in route:
+            exclude = tried + [provider for provider in ACTIVE_PROVIDERS if provider not in providers]
+            if auto_provider.ranked(exclude):
+                return model, pick(exclude=exclude), exclude
+            saturated = saturated or bool(auto_provider.available(exclude))
+        if not saturated:
+            raise Exception("All providers are temporarily unavailable")
+        try:
+            await auto_provider.wait_for_capacity(deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            raise TimeoutError("Request deadline exceeded waiting for a provider below its concurrency limit")
+
+
+async def generate_text(messages, key, stream=True, pick=None, route=None, deadline=None):
+    # One upstream generation with retries, shared by identical requests.
+    # `pick` chooses the provider for each attempt among those serving the
+    # model of the `route` (see routing.py) currently being tried. Attempts
+    # must finish by `deadline` (see request_deadline).
+    pick = pick or auto_provider.get_provider
+    route = route or router.resolve(DEFAULT_MODEL)
+    deadline = deadline or time.monotonic() + REQUEST_TIMEOUT
+    retries = 3
+    tried = []
+    parts = []
+    for attempt in range(retries):
+        # After a mid-stream failure, ask the next provider to continue the
+        # partial answer instead of starting over
+        sent = ''.join(parts)
+        prompt = continuation_messages(messages, sent) if sent else messages
+        if deadline <= time.monotonic():
+            raise TimeoutError("Request deadline exceeded")
+        with tracing.span('get_provider') as span:
+            model, provider, exclude = await pick_route(pick, route, tried, deadline)
+            span.update(provider=provider.__name__, model=model)
+        # Measured after the pick, which may have waited for capacity
+        timeout = min(PROVIDER_TIMEOUT, deadline - time.monotonic())
+        if timeout <= 0:
+            auto_provider.release(provider)
+            raise TimeoutError("Request deadline exceeded")
+        chunks = HedgedStream(auto_provider, provider, open_stream(prompt, model, timeout), exclude)
+        try:
+            with tracing.span('attempt', number=attempt + 1, model=model) as span:
+                if sent:
+                    logger.info(f"Continuing after {len(sent)} characters with provider: {chunks.provider.__name__} ({model or 'default model'})")
+                else:
+                    logger.info(f"Trying provider: {chunks.provider.__name__} ({model or 'default model'})")
+
+                received = len(parts)
+                if stream or hedging_enabled():
+                    # Hedging races on the first chunk, so it always streams
+                    async with aclosing(splice(sent, chunks) if sent else chunks.__aiter__()) as contents:
+                        async for content in contents:
+                            if len(parts) == received:
+                                tracing.mark('first_chunk', provider=chunks.provider.__name__)
+                            parts.append(content)
+                            yield content
+                else:
+                    start = time.monotonic()
+                    try:
+                        content = await asyncio.wait_for(complete(chunks.provider, messages, model=model, timeout=timeout), timeout)
+                    except asyncio.CancelledError:
+                        auto_provider.release(chunks.provider)
+                        raise
+                    elapsed = time.monotonic() - start
+                    auto_provider.record_response(chunks.provider, elapsed, content)
+                    tracing.mark('first_chunk', provider=chunks.provider.__name__)
+                    parts.append(content)
+                    yield content
+                tracing.mark('last_chunk', chunks=len(parts) - received)
+                span['provider'] = chunks.provider.__name__
+            text = ''.join(parts)
+            if CACHE_ENABLED and key is not None and text:
+                response_cache.put(key, text)
+            return
+
+        except Exception as e:
+            span['provider'] = chunks.provider.__name__
+            logger.warning(f"Provider {chunks.provider.__name__} failed: {str(e) or type(e).__name__}")
+            if timeout < PROVIDER_TIMEOUT and classify(e) == 'timeout':
+                # Timed out on the client's own deadline rather than ours,
+                # which says nothing about the provider's health
+                auto_provider.release(chunks.provider)
+            else:
+                auto_provider.mark_failed(chunks.provider, e)
+            tried.append(chunks.provider)
+            delay = 0 if parts else 2 ** attempt
+            if attempt < retries - 1 and deadline - time.monotonic() - delay >= MIN_ATTEMPT_SECONDS:
+                PROVIDER_RETRIES.inc((chunks.provider.__name__,))
+                if delay:
+                    logger.info(f"Retrying in {delay} seconds...")
+                    with tracing.span('backoff', seconds=delay):
+                        await backoff(attempt)
+            else:
+                logger.error(f"Generation failed after {attempt + 1} attempts: {str(e) or type(e).__name__}")
+                raise
+
+
+def cached(key):
+    return response_cache.get(key) if CACHE_ENABLED and key is not None else None
+
+
+def admit(headers, key, deadline, priority=None):
+    # Waits for an upstream slot from the scheduler (see scheduler.py) and
+    # returns its ticket; raises Overloaded when the queue is full. Cache hits
+    # and joiners of an identical request in flight don't queue.
+    return _admit(key, request_tenant(headers), priority or request_priority(headers), deadline)
+
+
+async def _admit(key, tenant, priority, deadline):
+    with tracing.span('admit', priority=priority) as span:
+        # Only a peek: the route looks the answer up itself, and counts it
+        if CACHE_ENABLED and key is not None and response_cache.peek(key):
+            span['outcome'] = 'cache_hit'
+            return Ticket()
+        if flights.joinable(key):
+            span['outcome'] = 'joined'
+            return Ticket()
+        span['outcome'] = 'queued'
+        return await scheduler.admit(tenant, priority, deadline)
+
+
+def shared_text(messages, key, stream=True, route=None, deadline=None):
+    # Text chunks of the generation for `key`, joined by identical requests
+    # already in flight on any protocol. Joiners share the first request's
+    # deadline.
+    return flights.stream(key, lambda: generate_text(messages, key, stream, route=route, deadline=deadline))
+
+
+async def full_text(messages, key, route=None, deadline=None):
+    async with aclosing(shared_text(messages, key, stream=False, route=route, deadline=deadline)) as chunks:
+        return ''.join([chunk async for chunk in chunks])
+
+
+async def fit_context(messages, route=None, deadline=None, pinned=None):
+    # `messages` within the context budget of the route's model (see
+    # context_budget.py); summaries of older turns go through the same route
+    route = route or router.resolve(DEFAULT_MODEL)
+    summarize = lambda prompt: full_text(prompt, cache_key(prompt, {}), route=route, deadline=deadline)
+    with tracing.span('fit_context') as span:
+        fitted = await context_budget.fit(messages, route[0][0], summarize, pinned)
+        if fitted is not messages:
+            span['trimmed'] = len(messages) - len(fitted)
+        return fitted
+
+
+Collected('gpt_provider_circuit_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)',
+          ('provider',), auto_provider.circuit_states)
+Collected('gpt_provider_concurrency', 'Adaptive concurrency limit and requests in flight per provider',
+          ('provider', 'kind'), auto_provider.concurrency)
+Collected('gpt_cache_lookups_total', 'Response cache lookups by result', ('result',),
+          response_cache.lookups, kind='counter')
+Collected('gpt_upstream_connections', 'Pooled upstream connections per provider, in use or idle',
+          ('provider', 'state'), pool.connections)
+Collected('gpt_sessions', 'Server-side conversations held in memory', (),
+          lambda: {(): len(sessions.entries)})
+Collected('gpt_singleflight_in_flight', 'Distinct upstream generations shared by in-flight requests', (),
+          lambda: {(): flights.in_flight()})
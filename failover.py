@@ -0,0 +1,48 @@
+from contextlib import aclosing
+from typing import List
+
+# Sent to the next provider when a stream dies part-way through an answer
+CONTINUE_PROMPT = ("Your previous reply was cut off. Continue it exactly where it stopped, "
+                   "without repeating any of it and without adding any commentary.")
+# How much of a continuation is held back to detect text the client already has
+OVERLAP_LOOKAHEAD = 200
+MIN_OVERLAP = 8
+
+
+def continuation_messages(messages: List[dict], sent: str) -> List[dict]:
+    return messages + [
+        {"role": "assistant", "content": sent},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
+
+
+def trim_overlap(sent: str, text: str) -> str:
+    # Providers often restart the answer or repeat the last sentence
+    if text.startswith(sent):
+        return text[len(sent):]
+    if sent.startswith(text):
+        return ''
+    for size in range(min(len(sent), len(text)), MIN_OVERLAP - 1, -1):
+        if sent.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+async def splice(sent: str, chunks):
+    # Continue `sent` with the chunks of a continuation, dropping whatever
+    # the continuation repeats of it
+    buffered = ''
+    async with aclosing(chunks.__aiter__()) as chunks:
+        async for chunk in chunks:
+            if buffered is None:
+                yield chunk
+                continue
+            buffered += chunk
+            if len(buffered) >= OVERLAP_LOOKAHEAD and not sent.startswith(buffered):
+                text, buffered = trim_overlap(sent, buffered), None
+                if text:
+                    yield text
+    if buffered:
+        text = trim_overlap(sent, buffered)
+        if text:
+            yield text
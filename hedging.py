@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from os import environ
+from typing import Callable, Optional
+
+from providers import AutoProvider
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Fixed delay (seconds) before racing a second provider; 0 disables hedging
+HEDGE_DELAY = float(environ.get('HEDGE_DELAY', '0'))
+# When set (e.g. 95), hedge after that percentile of the provider's recent TTFT
+HEDGE_PERCENTILE = float(environ.get('HEDGE_PERCENTILE', '0'))
+
+
+def hedging_enabled() -> bool:
+    return HEDGE_DELAY > 0 or HEDGE_PERCENTILE > 0
+
+
+def hedge_delay(auto_provider: AutoProvider, provider) -> Optional[float]:
+    if HEDGE_PERCENTILE > 0:
+        delay = auto_provider.ttft_percentile(provider, HEDGE_PERCENTILE)
+        if delay is not None:
+            return delay
+    return HEDGE_DELAY or None
+
+
+class HedgedStream:
+    # Streams text chunks from `provider`. If no first chunk arrives within the
+    # hedge delay, the same request goes to the next-best provider and whichever
+    # produces output first is kept; the other one is cancelled.
+    #
+    # `provider` always names the provider responsible for the stream, so the
+    # caller can mark it failed if iteration raises. Providers that fail while
+    # another one is still racing are marked failed here. `exclude` lists
+    # providers the backup must not be, e.g. ones that don't serve the model.
+    def __init__(self, auto_provider: AutoProvider, provider, open_stream: Callable, exclude=()):
+        self.auto_provider = auto_provider
+        self.provider = provider
+        self.open_stream = open_stream
+        self.exclude = tuple(exclude)
+
+    async def __aiter__(self):
+        streams = {self.provider: self.open_stream(self.provider)}
+        started = {self.provider: time.monotonic()}
+        pending = {asyncio.ensure_future(streams[self.provider].__anext__()): self.provider}
+        delay = hedge_delay(self.auto_provider, self.provider)
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    backup = self.backup(streams)
+                    if backup is not None:
+                        logger.info(f"No first chunk from {self.provider.__name__} after {delay:.2f}s, hedging with {backup.__name__}")
+                        tracing.mark('hedge', provider=backup.__name__)
+                        streams[backup] = self.open_stream(backup)
+                        started[backup] = time.monotonic()
+                        pending[asyncio.ensure_future(streams[backup].__anext__())] = backup
+                    delay = None
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except Exception as e:
+                        if not pending:
+                            self.provider = provider
+                            raise
+                        logger.warning(f"Provider {provider.__name__} failed while hedging: {str(e)}")
+                        self.auto_provider.mark_failed(provider, e)
+                        self.provider = next(iter(pending.values()))
+                        continue
+                    self.provider = provider
+                    for loser in pending.values():
+                        self.auto_provider.record_abandoned(loser, time.monotonic() - started[loser])
+                    await cancel(pending, streams)
+                    if first is not None:
+                        yield first
+                        async for chunk in streams[provider]:
+                            yield chunk
+                    return
+        finally:
+            await cancel(pending, streams)
+            # Also the winner's stream, when the consumer stops early
+            for stream in streams.values():
+                await stream.aclose()
+
+    def backup(self, streams):
+        try:
+            return self.auto_provider.get_provider(exclude=tuple(streams) + self.exclude)
+        except Exception:
+            return None
+
+
+async def cancel(pending: dict, streams: dict):
+    # Stop the losing requests and close their upstream generators
+    losers = set(pending.values())
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+    pending.clear()
+    for provider in losers:
+        await streams[provider].aclose()
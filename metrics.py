@@ -0,0 +1,153 @@
+import time
+from bisect import bisect_left
+from contextlib import aclosing, contextmanager
+from typing import Callable, Dict, Tuple
+
+import tracing
+
+# Prometheus text exposition without a client library. Updates are plain dict
+# arithmetic with no locks: generation runs on a single event loop thread, and
+# the hot paths count locally and add their totals once per stream.
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name, _labels(self.labels, labels), value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for name, labels, value in self.samples():
+            yield f"{name}{labels} {value}"
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, labels: Tuple = ()):
+        # One slot per bucket plus +Inf, then sum and count
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def samples(self):
+        for labels, entry in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.labels + ('le',), labels + (bound,)), cumulative
+            yield f"{self.name}_sum", _labels(self.labels, labels), entry[-2]
+            yield f"{self.name}_count", _labels(self.labels, labels), entry[-1]
+
+
+class Collected(Counter):
+    # Values read from another component at scrape time
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], collect: Callable[[], Dict[Tuple, float]],
+                 kind: str = 'gauge'):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        self.values = self.collect()
+        return super().samples()
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+ROUTE_REQUESTS = Counter('gpt_route_requests_total', 'Requests received per route', ('route',))
+ROUTE_DURATION = Histogram('gpt_route_duration_seconds', 'Time to serve a request, until the end of the stream', ('route',))
+STREAMS_IN_FLIGHT = Gauge('gpt_streams_in_flight', 'SSE responses currently streaming', ('route',))
+STREAM_CHUNKS = Counter('gpt_stream_chunks_total', 'SSE events written to clients', ('route',))
+STREAM_BYTES = Counter('gpt_stream_bytes_total', 'Size of the SSE events written to clients', ('route',))
+
+PROVIDER_REQUESTS = Counter('gpt_provider_requests_total', 'Upstream requests sent per provider', ('provider',))
+PROVIDER_FAILURES = Counter('gpt_provider_failures_total', 'Upstream failures by exception class', ('provider', 'error'))
+PROVIDER_RETRIES = Counter('gpt_provider_retries_total', 'Retries caused by a provider failure', ('provider',))
+PROVIDER_TTFT = Histogram('gpt_provider_ttft_seconds', 'Time to first chunk from the provider', ('provider',))
+PROVIDER_DURATION = Histogram('gpt_provider_duration_seconds', 'Total upstream generation time', ('provider',))
+PROVIDER_CHUNKS = Counter('gpt_provider_chunks_total', 'Text chunks received from the provider', ('provider',))
+PROVIDER_BYTES = Counter('gpt_provider_bytes_total', 'Characters of text received from the provider', ('provider',))
+
+BACKOFF_SECONDS = Counter('gpt_backoff_seconds_total', 'Time spent sleeping between retries')
+PROCESS_CPU = Collected('process_cpu_seconds_total', 'Total user and system CPU time spent in seconds', (),
+                        lambda: {(): time.process_time()}, kind='counter')
+
+
+@contextmanager
+def track_request(route: str):
+    ROUTE_REQUESTS.inc((route,))
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        ROUTE_DURATION.observe(time.monotonic() - start, (route,))
+
+
+async def instrument_stream(route: str, events):
+    labels = (route,)
+    ROUTE_REQUESTS.inc(labels)
+    STREAMS_IN_FLIGHT.inc(labels)
+    start = time.monotonic()
+    chunks = size = 0
+    status = 'cancelled'
+    try:
+        async with aclosing(events):
+            async for event in events:
+                chunks += 1
+                size += len(event)
+                yield event
+        status = 'ok'
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        # The trace of a streamed response ends with the stream
+        tracing.finish(status)
+        STREAMS_IN_FLIGHT.dec(labels)
+        STREAM_CHUNKS.inc(labels, chunks)
+        STREAM_BYTES.inc(labels, size)
+        ROUTE_DURATION.observe(time.monotonic() - start, labels)
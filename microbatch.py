@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from os import environ
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Micro-batching of short /v1/direct requests. Requests with the same system
+# prompt, target language and model arriving within MICROBATCH_WINDOW
+# seconds of each other (up to MICROBATCH_MAX_ITEMS of them) go upstream as
+# one tagged prompt, and the answer is split back out to each caller. A
+# request waiting alone, or an answer that can't be split, falls back to the
+# request's own upstream call. MICROBATCH=1 turns it on for every request; a
+# request can also set "microbatch": true or false itself.
+MICROBATCH = environ.get('MICROBATCH', '0') != '0'
+MICROBATCH_WINDOW = float(environ.get('MICROBATCH_WINDOW', '0.01'))
+MICROBATCH_MAX_ITEMS = int(environ.get('MICROBATCH_MAX_ITEMS', '16'))
+# Longer texts are translated on their own
+MICROBATCH_MAX_CHARS = int(environ.get('MICROBATCH_MAX_CHARS', '500'))
+
+ITEMS = Counter('gpt_microbatch_items_total', 'Short /v1/direct requests by how they were sent upstream', ('result',))
+
+# Sends the texts of a batch by the given deadline; returns their
+# translations in order, or None when the answer couldn't be split
+Send = Callable[[List[str], float], Awaitable[Optional[List[str]]]]
+
+
+def microbatch_enabled(jsong: dict) -> bool:
+    return bool(jsong.get('microbatch', MICROBATCH))
+
+
+def short_text(text: Optional[str]) -> bool:
+    return text is not None and 0 < len(text) <= MICROBATCH_MAX_CHARS
+
+
+class Batch:
+    def __init__(self, send: Send):
+        self.send = send
+        self.texts = []
+        self.futures = []
+        self.deadline = None
+        self.timer = None
+        self.task = None
+
+
+class MicroBatcher:
+    def __init__(self, window: float = MICROBATCH_WINDOW, max_items: int = MICROBATCH_MAX_ITEMS):
+        self.window = window
+        self.max_items = max_items
+        self.batches: Dict[tuple, Batch] = {}
+
+    async def submit(self, group: str, text: str, deadline: float, send: Send) -> Optional[str]:
+        # The translation of `text`, or None when the caller should send it
+        # on its own. `send` of the first request in a batch sends all of it.
+        loop = asyncio.get_running_loop()
+        key = (loop, group)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = Batch(send)
+            batch.timer = loop.call_later(self.window, self.flush, key, batch)
+        future = loop.create_future()
+        batch.texts.append(text)
+        batch.futures.append(future)
+        batch.deadline = deadline if batch.deadline is None else min(batch.deadline, deadline)
+        if len(batch.texts) >= self.max_items:
+            self.flush(key, batch)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Stop paying for the batch once every caller has left
+            if batch.task is not None and all(future.cancelled() for future in batch.futures):
+                batch.task.cancel()
+            raise
+
+    def flush(self, key: tuple, batch: Batch):
+        if self.batches.get(key) is batch:
+            del self.batches[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        if batch.task is not None:
+            return
+        waiting = [(text, future) for text, future in zip(batch.texts, batch.futures) if not future.done()]
+        if len(waiting) < 2:
+            ITEMS.inc(('alone',), len(waiting))
+            for _, future in waiting:
+                future.set_result(None)
+            return
+        batch.task = asyncio.ensure_future(self.run(batch, waiting))
+
+    async def run(self, batch: Batch, waiting: list):
+        texts = [text for text, _ in waiting]
+        try:
+            translations = await batch.send(texts, batch.deadline)
+        except Exception as e:
+            for _, future in waiting:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if translations is None:
+            logger.warning(f"Micro-batch answer for {len(texts)} requests didn't match, sending them one by one")
+            ITEMS.inc(('fallback',), len(texts))
+            translations = [None] * len(texts)
+        else:
+            ITEMS.inc(('batched',), len(texts))
+        for (_, future), translation in zip(waiting, translations):
+            if not future.done():
+                future.set_result(translation)
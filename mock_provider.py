@@ -0,0 +1,87 @@
+import asyncio
+import random
+from os import environ
+from typing import List
+
+from g4f import errors
+from g4f.Provider.base_provider import AsyncGeneratorProvider
+
+# Local stand-in for upstream providers, for benchmarks and load tests that
+# shouldn't depend on flaky, rate-limited third parties. Set MOCK_PROVIDERS to
+# replace ACTIVE_PROVIDERS, e.g.
+#   MOCK_PROVIDERS="fast:ttft=0.1,tps=200;flaky:error_rate=0.3,error=RateLimitError|TimeoutError;cut:midstream_rate=0.5"
+MOCK_PROVIDERS = environ.get('MOCK_PROVIDERS', '')
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua.')
+
+# Config keys accepted in MOCK_PROVIDERS and the attributes they set
+OPTIONS = {
+    'ttft': ('ttft', float),
+    'jitter': ('jitter', float),
+    'tps': ('tokens_per_sec', float),
+    'tokens': ('tokens', int),
+    'error_rate': ('error_rate', float),
+    'midstream_rate': ('midstream_rate', float),
+    'error': ('errors', lambda value: tuple(value.split('|'))),
+}
+
+
+def make_error(name: str, message: str) -> Exception:
+    # g4f's own exception classes, so circuit breakers classify them as real ones
+    cls = getattr(errors, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        raise ValueError(f"Unknown error type: {name}")
+    return cls(message)
+
+
+class MockProvider(AsyncGeneratorProvider):
+    url = 'http://localhost'
+    working = True
+    supports_stream = True
+    default_model = 'mock'
+    models = ['mock']
+
+    ttft = 0.2  # seconds before the first token
+    jitter = 0.0  # +/- fraction applied to ttft
+    tokens_per_sec = 50.0  # 0 streams without delays
+    tokens = 100
+    error_rate = 0.0  # share of requests failing before the first token
+    midstream_rate = 0.0  # share of requests failing part-way through the answer
+    errors = ('ResponseError',)
+
+    @classmethod
+    async def create_async_generator(cls, model: str, messages: List[dict], **kwargs):
+        await asyncio.sleep(max(0.0, cls.ttft * (1 + random.uniform(-cls.jitter, cls.jitter))))
+        if random.random() < cls.error_rate:
+            raise make_error(random.choice(cls.errors), f"{cls.__name__}: simulated failure")
+        cut = random.randrange(1, cls.tokens) if cls.tokens > 1 and random.random() < cls.midstream_rate else None
+        delay = 1 / cls.tokens_per_sec if cls.tokens_per_sec > 0 else 0
+        for i in range(cls.tokens):
+            if i == cut:
+                raise make_error(random.choice(cls.errors), f"{cls.__name__}: simulated failure after {i} tokens")
+            if i and delay:
+                await asyncio.sleep(delay)
+            yield WORDS[i % len(WORDS)] + ' '
+
+
+def make_provider(name: str, **options) -> type:
+    return type(name, (MockProvider,), options)
+
+
+def mock_providers(spec: str = MOCK_PROVIDERS) -> List[type]:
+    # "name:key=value,key=value;name2:..." -> provider classes
+    providers = []
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        name, _, settings = entry.partition(':')
+        options = {}
+        for setting in filter(None, settings.split(',')):
+            key, _, value = setting.partition('=')
+            if key not in OPTIONS:
+                raise ValueError(f"Unknown mock provider option: {key}")
+            attribute, convert = OPTIONS[key]
+            options[attribute] = convert(value)
+        for error in options.get('errors', ()):
+            make_error(error, '')  # fail at startup on a typo, not mid-benchmark
+        providers.append(make_provider(name, **options))
+    return providers
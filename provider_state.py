@@ -0,0 +1,52 @@
+import json
+import sqlite3
+from os import environ
+from typing import Dict, Optional, Tuple
+
+# SQLite file holding provider scores and circuit breakers. Every worker
+# process on the host opening the same file shares one view of provider
+# health, and it survives restarts. Empty keeps the state in-process.
+PROVIDER_STATE_DB = environ.get('PROVIDER_STATE_DB', '')
+
+
+class ProviderStateDB:
+    # One row per provider with its ProviderStats and CircuitBreaker state as
+    # JSON. Callers serialise access to a connection with their own lock.
+    def __init__(self, filename: str):
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS providers (name TEXT PRIMARY KEY, stats TEXT, breaker TEXT, updated REAL)")
+        self.version = None
+
+    def changed(self) -> bool:
+        # data_version only moves when another connection commits, so checking
+        # it costs one pragma and no reads while nothing has changed
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        changed = version != self.version
+        self.version = version
+        return changed
+
+    def load_all(self) -> Dict[str, Tuple[dict, dict]]:
+        rows = self.db.execute("SELECT name, stats, breaker FROM providers").fetchall()
+        return {name: (json.loads(stats), json.loads(breaker)) for name, stats, breaker in rows}
+
+    def begin(self):
+        # Takes the write lock up front so a read-modify-write of a provider
+        # can't interleave with another worker's
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def save(self, name: str, stats: dict, breaker: dict, now: float):
+        self.db.execute("INSERT OR REPLACE INTO providers VALUES (?, ?, ?, ?)",
+                        (name, json.dumps(stats), json.dumps(breaker), now))
+
+    def commit(self):
+        self.db.execute("COMMIT")
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.execute("ROLLBACK")
+
+
+def open_state(filename: str = PROVIDER_STATE_DB) -> Optional[ProviderStateDB]:
+    return ProviderStateDB(filename) if filename else None
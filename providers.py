@@ -0,0 +1,392 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import aclosing, contextmanager
+from os import environ
+from typing import Dict, List, Optional
+
+from g4f.Provider.base_provider import BaseProvider
+
+from aio import complete
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, classify
+from concurrency_limit import AdaptiveLimit
+from metrics import (PROVIDER_BYTES, PROVIDER_CHUNKS, PROVIDER_DURATION, PROVIDER_FAILURES,
+                     PROVIDER_REQUESTS, PROVIDER_TTFT)
+from provider_state import PROVIDER_STATE_DB, open_state
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the moving averages
+EWMA_ALPHA = float(environ.get('PROVIDER_EWMA_ALPHA', '0.2'))
+# Share of requests sent to a random healthy provider so slow ones get re-measured
+EXPLORE_RATE = float(environ.get('PROVIDER_EXPLORE_RATE', '0.05'))
+# Answer length used to turn tokens/sec into an expected latency
+REFERENCE_TOKENS = 200
+# Seconds between background probes of open circuits; 0 disables the prober
+HEALTH_CHECK_INTERVAL = float(environ.get('HEALTH_CHECK_INTERVAL', '0'))
+HEALTH_CHECK_TIMEOUT = 15
+HEALTH_CHECK_PROMPT = [{"role": "user", "content": "Reply with OK."}]
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _ewma(old: Optional[float], sample: float) -> float:
+    return sample if old is None else old + EWMA_ALPHA * (sample - old)
+
+
+class EmptyResponse(Exception):
+    # The provider answered without any text, a common g4f failure mode
+    pass
+
+
+class ProviderStats:
+    def __init__(self):
+        self.ttft = None
+        self.latency = None
+        self.tokens_per_sec = None
+        self.success_rate = 1.0
+        self.samples = 0
+        self.recent_ttft = deque(maxlen=100)
+
+    def record_success(self, ttft: float, total: float, tokens: int):
+        self.ttft = _ewma(self.ttft, ttft)
+        self.recent_ttft.append(ttft)
+        self.latency = _ewma(self.latency, total)
+        streaming_time = total - ttft
+        if streaming_time > 0:
+            self.tokens_per_sec = _ewma(self.tokens_per_sec, tokens / streaming_time)
+        self.success_rate = _ewma(self.success_rate, 1.0)
+        self.samples += 1
+
+    def record_abandoned(self, waited: float):
+        # Lost a hedge race before its first chunk: `waited` is a lower bound
+        self.ttft = _ewma(self.ttft, waited)
+        self.latency = _ewma(self.latency, waited)
+        self.recent_ttft.append(waited)
+
+    def record_failure(self):
+        self.success_rate = _ewma(self.success_rate, 0.0)
+        self.samples += 1
+
+    def ttft_percentile(self, percentile: float) -> float:
+        samples = sorted(self.recent_ttft)
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def expected_latency(self) -> Optional[float]:
+        if self.ttft is None:
+            return None
+        if self.tokens_per_sec:
+            return self.ttft + REFERENCE_TOKENS / self.tokens_per_sec
+        return self.latency
+
+    def score(self) -> float:
+        # Successful answers per second of waiting. Providers never tried come
+        # first; ones that have only ever failed come last.
+        expected = self.expected_latency()
+        if expected is None:
+            return float('inf') if self.samples == 0 else 0.0
+        return self.success_rate / max(expected, 0.05)
+
+    def dump(self) -> dict:
+        return {
+            "ttft": self.ttft,
+            "latency": self.latency,
+            "tokens_per_sec": self.tokens_per_sec,
+            "success_rate": self.success_rate,
+            "samples": self.samples,
+            "recent_ttft": list(self.recent_ttft),
+        }
+
+    def load(self, state: dict):
+        self.ttft = state["ttft"]
+        self.latency = state["latency"]
+        self.tokens_per_sec = state["tokens_per_sec"]
+        self.success_rate = state["success_rate"]
+        self.samples = state["samples"]
+        self.recent_ttft = deque(state["recent_ttft"], maxlen=self.recent_ttft.maxlen)
+
+    def to_dict(self) -> dict:
+        return {
+            "ttft": self.ttft,
+            "latency": self.latency,
+            "tokens_per_sec": self.tokens_per_sec,
+            "success_rate": self.success_rate,
+            "samples": self.samples,
+            "score": self.score(),
+        }
+
+
+class AutoProvider:
+    def __init__(self, providers: List[BaseProvider], state_file: str = PROVIDER_STATE_DB):
+        self.providers = providers
+        self.stats: Dict[str, ProviderStats] = {p.__name__: ProviderStats() for p in providers}
+        self.breakers: Dict[str, CircuitBreaker] = {p.__name__: CircuitBreaker() for p in providers}
+        # Concurrency limits stay per process, see concurrency_limit.py
+        self.limits: Dict[str, AdaptiveLimit] = {p.__name__: AdaptiveLimit() for p in providers}
+        # (loop, future) of requests waiting for a provider below its limit
+        self.waiters = []
+        self.lock = threading.Lock()
+        self.health_task = None
+        # With a state file, stats and breakers are shared with the other
+        # worker processes using it and restored after a restart
+        self.state = open_state(state_file)
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        # Pick up what other workers wrote since the last look; caller holds the lock
+        if self.state is None:
+            return
+        try:
+            if not self.state.changed():
+                return
+            rows = self.state.load_all()
+        except sqlite3.Error as e:
+            logger.warning(f"Reading provider state failed: {str(e)}")
+            return
+        for name, (stats, breaker) in rows.items():
+            if name in self.stats:
+                self.stats[name].load(stats)
+                self.breakers[name].load(breaker)
+
+    @contextmanager
+    def updating(self, provider: BaseProvider):
+        # Stats and breaker of one provider for a read-modify-write, written
+        # back to the state file atomically with respect to other workers
+        name = provider.__name__
+        with self.lock:
+            if self.state is None:
+                yield self.stats[name], self.breakers[name]
+                return
+            try:
+                self.state.begin()
+            except sqlite3.Error as e:
+                logger.warning(f"Locking provider state failed: {str(e)}")
+                yield self.stats[name], self.breakers[name]
+                return
+            try:
+                self._sync()
+                yield self.stats[name], self.breakers[name]
+                self.state.save(name, self.stats[name].dump(), self.breakers[name].dump(), time.time())
+                self.state.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Saving provider state failed: {str(e)}")
+            finally:
+                self.state.rollback()
+
+    def available(self, exclude=()) -> List[BaseProvider]:
+        current_time = time.time()
+        background_probe = self.health_task is not None and not self.health_task.done()
+        return [
+            provider for provider in self.providers
+            if provider not in exclude
+            and self.breakers[provider.__name__].available(current_time, background_probe)
+        ]
+
+    def ranked(self, exclude=()) -> List[BaseProvider]:
+        # Best score first; list order breaks ties. Providers at their
+        # concurrency limit are left out, so requests spill over to the others.
+        now = time.monotonic()
+        with self.lock:
+            self._sync()
+            candidates = [provider for provider in self.available(exclude) if not self.limits[provider.__name__].full(now)]
+            return sorted(candidates, key=lambda p: -self.stats[p.__name__].score())
+
+    async def wait_for_capacity(self, timeout: float):
+        # Until some request releases its slot, at most `timeout` seconds
+        future = asyncio.get_running_loop().create_future()
+        entry = (asyncio.get_running_loop(), future)
+        with self.lock:
+            self.waiters.append(entry)
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            with self.lock:
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+
+    def _wake(self):
+        # Caller holds the lock
+        waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    def get_provider(self, exclude=()):
+        candidates = self.ranked(exclude)
+        if not candidates:
+            raise Exception("All providers are temporarily unavailable")
+        if len(candidates) > 1 and random.random() < EXPLORE_RATE:
+            provider = random.choice(candidates[1:])
+        else:
+            provider = candidates[0]
+        self.claim(provider)
+        return provider
+
+    def claim(self, provider: BaseProvider):
+        # A request is about to be sent to `provider`
+        with self.updating(provider) as (_, breaker):
+            breaker.acquire(time.time())
+            self.limits[provider.__name__].acquire(time.monotonic())
+        PROVIDER_REQUESTS.inc((provider.__name__,))
+
+    def release(self, provider: BaseProvider):
+        # A claimed request was cut short (client gone, lost a hedge race)
+        # without telling us anything about the provider
+        with self.updating(provider) as (_, breaker):
+            breaker.release()
+            self.limits[provider.__name__].release(time.monotonic())
+            self._wake()
+
+    def record_success(self, provider: BaseProvider, ttft: float, total: float, tokens: int):
+        with self.updating(provider) as (stats, breaker):
+            stats.record_success(ttft, total, tokens)
+            breaker.record_success(time.time())
+            self.limits[provider.__name__].record_success(time.monotonic(), ttft)
+            self._wake()
+
+    def record_abandoned(self, provider: BaseProvider, waited: float):
+        # Its stream is cancelled next, which releases the concurrency slot
+        with self.updating(provider) as (stats, breaker):
+            stats.record_abandoned(waited)
+            breaker.release()
+
+    def ttft_percentile(self, provider: BaseProvider, percentile: float, min_samples: int = 10) -> Optional[float]:
+        with self.lock:
+            self._sync()
+            stats = self.stats[provider.__name__]
+            if len(stats.recent_ttft) < min_samples:
+                return None
+            return stats.ttft_percentile(percentile)
+
+    async def track(self, provider: BaseProvider, chunks, deadline: Optional[float] = None):
+        # Pass text chunks through while measuring TTFT, latency and throughput.
+        # Past the monotonic `deadline` it raises TimeoutError, whether or not
+        # the provider honours the timeout it was given.
+        start = time.monotonic()
+        ttft = None
+        text_length = 0
+        count = 0
+        try:
+            async with aclosing(chunks):
+                while True:
+                    try:
+                        if deadline is None:
+                            chunk = await chunks.__anext__()
+                        else:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+                    except StopAsyncIteration:
+                        break
+                    if ttft is None:
+                        ttft = time.monotonic() - start
+                    text_length += len(chunk)
+                    count += 1
+                    yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            # Closed before the end; failures are marked by the caller instead
+            self.release(provider)
+            raise
+        if not text_length:
+            raise EmptyResponse(f"{provider.__name__} returned an empty answer")
+        total = time.monotonic() - start
+        if ttft is None:
+            ttft = total
+        self.record_success(provider, ttft, total, max(1, text_length // 4))
+        labels = (provider.__name__,)
+        PROVIDER_TTFT.observe(ttft, labels)
+        PROVIDER_DURATION.observe(total, labels)
+        PROVIDER_CHUNKS.inc(labels, count)
+        PROVIDER_BYTES.inc(labels, text_length)
+
+    def record_response(self, provider: BaseProvider, elapsed: float, text: str):
+        # Non-streaming counterpart of track()
+        if not text:
+            raise EmptyResponse(f"{provider.__name__} returned an empty answer")
+        self.record_success(provider, elapsed, elapsed, estimate_tokens(text))
+        labels = (provider.__name__,)
+        PROVIDER_TTFT.observe(elapsed, labels)
+        PROVIDER_DURATION.observe(elapsed, labels)
+        PROVIDER_CHUNKS.inc(labels)
+        PROVIDER_BYTES.inc(labels, len(text))
+
+    def mark_failed(self, provider: BaseProvider, error: Optional[BaseException] = None):
+        PROVIDER_FAILURES.inc((provider.__name__, type(error).__name__ if error is not None else 'unknown'))
+        with self.updating(provider) as (stats, breaker):
+            stats.record_failure()
+            was_open = breaker.state == OPEN
+            breaker.record_failure(time.time(), error)
+            self.limits[provider.__name__].record_failure(time.monotonic(), classify(error) if error is not None else None)
+            self._wake()
+            if breaker.state == OPEN and not was_open:
+                logger.warning(f"Circuit for {provider.__name__} open for {breaker.open_until - time.time():.0f}s ({breaker.last_error})")
+
+    def start_health_checks(self, loop: asyncio.AbstractEventLoop = None):
+        # Probe open circuits in the background instead of with user requests
+        if HEALTH_CHECK_INTERVAL <= 0 or (self.health_task is not None and not self.health_task.done()):
+            return
+        if loop is None:
+            self.health_task = asyncio.ensure_future(self.health_check_loop())
+        else:
+            self.health_task = asyncio.run_coroutine_threadsafe(self.health_check_loop(), loop)
+
+    async def health_check_loop(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            current_time = time.time()
+            with self.lock:
+                self._sync()
+                tripped = [provider for provider in self.providers if self.breakers[provider.__name__].state != CLOSED]
+            due = []
+            for provider in tripped:
+                # Claimed under the shared state, so only one worker probes each provider
+                with self.updating(provider) as (_, breaker):
+                    if breaker.state != CLOSED and breaker.available(current_time):
+                        breaker.acquire(current_time)
+                        due.append(provider)
+            await asyncio.gather(*[self.probe(provider) for provider in due])
+
+    async def probe(self, provider: BaseProvider):
+        try:
+            text = await asyncio.wait_for(complete(provider, HEALTH_CHECK_PROMPT, timeout=HEALTH_CHECK_TIMEOUT), HEALTH_CHECK_TIMEOUT)
+            if not text:
+                raise EmptyResponse(f"{provider.__name__} returned an empty answer")
+        except Exception as e:
+            logger.info(f"Health check for {provider.__name__} failed: {str(e) or type(e).__name__}")
+            with self.updating(provider) as (_, breaker):
+                breaker.record_failure(time.time(), e)
+            return
+        logger.info(f"Health check for {provider.__name__} passed, closing circuit")
+        with self.updating(provider) as (_, breaker):
+            breaker.record_success(time.time())
+
+    def circuit_states(self) -> dict:
+        codes = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+        with self.lock:
+            self._sync()
+            return {(name,): codes[breaker.state] for name, breaker in self.breakers.items()}
+
+    def concurrency(self) -> dict:
+        # Limit and requests in flight per provider, for metrics
+        now = time.monotonic()
+        with self.lock:
+            return {
+                (name, kind): value
+                for name, limit in self.limits.items()
+                for kind, value in (('limit', limit.limit), ('in_flight', limit.to_dict(now)['in_flight']))
+            }
+
+    def snapshot(self) -> dict:
+        current_time = time.time()
+        now = time.monotonic()
+        with self.lock:
+            self._sync()
+            return {
+                name: dict(stats.to_dict(), circuit=self.breakers[name].to_dict(current_time),
+                           concurrency=self.limits[name].to_dict(now))
+                for name, stats in self.stats.items()
+            }
@@ -0,0 +1,165 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from json import dumps
+from os import environ
+from typing import List, Optional
+
+# RESPONSE_CACHE=0 disables caching; CACHE_DB enables the on-disk tier
+CACHE_ENABLED = environ.get('RESPONSE_CACHE', '1') != '0'
+CACHE_TTL = float(environ.get('CACHE_TTL', '3600'))
+CACHE_MAX_ENTRIES = int(environ.get('CACHE_MAX_ENTRIES', '10000'))
+CACHE_MAX_BYTES = int(environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_DB = environ.get('CACHE_DB', '')
+
+# Request fields that change the answer, besides messages and model
+SAMPLING_PARAMS = ('temperature', 'top_p', 'top_k', 'max_tokens', 'stop', 'seed',
+                   'presence_penalty', 'frequency_penalty')
+
+# Size of the text pieces a cached answer is replayed in as an SSE stream
+REPLAY_CHUNK_CHARS = 256
+
+
+def cache_key(messages: List[dict], jsong: dict) -> str:
+    params = {name: jsong[name] for name in SAMPLING_PARAMS if name in jsong}
+    payload = dumps([messages, jsong.get('model'), params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cache_bypassed(jsong: dict, headers) -> bool:
+    # The client wants a fresh answer (e.g. "regenerate"): Cache-Control:
+    # no-cache or no-store, or "cache": false in the body
+    control = (headers.get('Cache-Control') or '').lower()
+    return jsong.get('cache') is False or 'no-cache' in control or 'no-store' in control
+
+
+def request_key(messages: List[dict], jsong: dict, headers=None) -> Optional[str]:
+    # The request's cache_key, or None when it bypasses the cache. A request
+    # without a key is neither answered from nor written to the cache, and
+    # doesn't join an identical request in flight either.
+    if cache_bypassed(jsong, headers or {}):
+        return None
+    return cache_key(messages, jsong)
+
+
+def replay_chunks(text: str):
+    for i in range(0, len(text), REPLAY_CHUNK_CHARS):
+        yield text[i:i + REPLAY_CHUNK_CHARS]
+
+
+class DiskCache:
+    def __init__(self, filename: str):
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT, expires REAL)")
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT text, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            return row[0]
+
+    def put(self, key: str, text: str, expires: float):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, expires))
+
+    def purge_expired(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+
+
+class ResponseCache:
+    # In-memory LRU with TTL and entry/byte limits, backed by an optional
+    # SQLite tier that survives restarts.
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES,
+                 max_bytes: int = CACHE_MAX_BYTES, filename: str = CACHE_DB):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (text, size, expires)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk = DiskCache(filename) if filename else None
+        if self.disk:
+            self.disk.purge_expired()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[2] >= now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._evict(key)
+        text = self.disk.get(key) if self.disk else None
+        with self.lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._store(key, text, now + self.ttl)
+        return text
+
+    def peek(self, key: str) -> bool:
+        # Whether `key` would hit, without counting a lookup or touching the LRU
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] >= time.time():
+                return True
+        return bool(self.disk) and self.disk.get(key) is not None
+
+    def put(self, key: str, text: str):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._store(key, text, expires)
+        if self.disk:
+            self.disk.put(key, text, expires)
+
+    def _store(self, key: str, text: str, expires: float):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._evict(key)
+        self.entries[key] = (text, size, expires)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def lookups(self) -> dict:
+        with self.lock:
+            return {
+                ('memory_hit',): self.hits - self.disk_hits,
+                ('disk_hit',): self.disk_hits,
+                ('miss',): self.misses,
+            }
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": CACHE_ENABLED,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "disk": bool(self.disk),
+            }
@@ -0,0 +1,127 @@
+import json
+import logging
+from collections import defaultdict
+from os import environ
+from typing import Dict, List, Tuple
+
+from g4f.models import ModelUtils
+
+logger = logging.getLogger(__name__)
+
+# Route for requests without a model, or for a model no provider serves
+DEFAULT_MODEL = environ.get('DEFAULT_MODEL', 'gpt-4')
+# JSON file overriding the routes derived from g4f's metadata, e.g.
+#   {"models": {"gpt-4o-mini": {"providers": ["PollinationsAI"], "fallback": ["gpt-4"]}},
+#    "aliases": {"gpt-4-turbo": "gpt-4"}}
+MODEL_ROUTES = environ.get('MODEL_ROUTES', '')
+
+# Provider model lists and g4f model classes that aren't chat models
+NON_CHAT_MODELS = ('image_models', 'audio_models', 'video_models')
+NON_CHAT_CLASSES = {'ImageModel', 'AudioModel', 'VideoModel'}
+
+
+def _names(best_provider) -> List[str]:
+    # A g4f Model's best_provider is a provider or an IterListProvider of them
+    if best_provider is None:
+        return []
+    providers = getattr(best_provider, 'providers', None) or [best_provider]
+    return [getattr(provider, '__name__', type(provider).__name__) for provider in providers]
+
+
+def _chat_models(provider) -> List[str]:
+    # Model ids a provider class declares, without asking it over the network
+    declared = []
+    for attribute in ('models', 'model_aliases'):
+        value = getattr(provider, attribute, None)
+        if isinstance(value, (list, tuple, set, dict)):
+            declared.extend(name for name in value if isinstance(name, str))
+    if isinstance(getattr(provider, 'default_model', None), str):
+        declared.append(provider.default_model)
+    excluded = set()
+    for attribute in NON_CHAT_MODELS:
+        value = getattr(provider, attribute, None)
+        if isinstance(value, (list, tuple, set, dict)):
+            excluded.update(value)
+    return [name for name in declared if name and name not in excluded]
+
+
+def load_config(filename: str = MODEL_ROUTES) -> dict:
+    if not filename:
+        return {}
+    with open(filename, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class ModelRouter:
+    # Index from requested model id to the active providers serving it, built
+    # once at startup. A route is the model's fallback chain: (model id,
+    # providers) pairs tried in order until one has a provider left.
+    def __init__(self, providers: List, config: dict = None):
+        self.providers = providers
+        self.routes: Dict[str, List] = {}
+        self.aliases: Dict[str, str] = {}
+        self.fallbacks: Dict[str, List[str]] = {}
+        self.owners: Dict[str, str] = {}
+
+        by_name = {provider.__name__: provider for provider in providers}
+        served = defaultdict(set)
+        for name, model in ModelUtils.convert.items():
+            if {cls.__name__ for cls in type(model).__mro__} & NON_CHAT_CLASSES:
+                continue
+            self.owners[name] = getattr(model, 'base_provider', '') or 'g4f'
+            served[name].update(provider for provider in _names(model.best_provider) if provider in by_name)
+        for provider in providers:
+            for name in _chat_models(provider):
+                served[name].add(provider.__name__)
+
+        config = config or {}
+        for name, override in config.get('models', {}).items():
+            if 'providers' in override:
+                unknown = [provider for provider in override['providers'] if provider not in by_name]
+                if unknown:
+                    logger.warning(f"Model route {name} names inactive providers: {', '.join(unknown)}")
+                served[name] = set(override['providers']) & set(by_name)
+            if 'fallback' in override:
+                self.fallbacks[name] = list(override['fallback'])
+        self.aliases.update(config.get('aliases', {}))
+
+        # Keep ACTIVE_PROVIDERS order; AutoProvider re-ranks within a route anyway
+        for name, names in served.items():
+            if names:
+                self.routes[name] = [provider for provider in providers if provider.__name__ in names]
+        logger.info(f"Routing {len(self.routes)} models over {len(providers)} providers")
+
+    def resolve(self, model: str, default: str = DEFAULT_MODEL) -> List[Tuple[str, List]]:
+        chain = []
+        seen = set()
+        pending = [self.aliases.get(model, model)] if model else []
+        while pending:
+            name = pending.pop(0)
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in self.routes:
+                chain.append((name, self.routes[name]))
+            pending.extend(self.aliases.get(fallback, fallback) for fallback in self.fallbacks.get(name, ()))
+        if chain:
+            return chain
+        if default:
+            return self.resolve(default, '')
+        # Nothing known about the model: any provider, with its own default model
+        return [('', self.providers)]
+
+    def model_ids(self) -> List[str]:
+        aliases = [alias for alias, target in self.aliases.items() if target in self.routes]
+        return sorted(set(self.routes) | set(aliases))
+
+    def listing(self) -> List[dict]:
+        return [
+            {
+                "id": name,
+                "object": "model",
+                "created": 0,
+                "owned_by": self.owners.get(self.aliases.get(name, name), 'g4f'),
+                "providers": [provider.__name__ for provider in self.routes[self.aliases.get(name, name)]],
+            }
+            for name in self.model_ids()
+        ]
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+import time
+import weakref
+from contextlib import aclosing
+from os import environ
+from typing import Dict, List, Optional
+
+from metrics import Collected, Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Admission in front of provider dispatch. At most SCHEDULER_SLOTS requests
+# generate upstream at once; the rest wait in a queue per priority class.
+# Interactive requests always go before batch ones, and within a class each
+# tenant gets a share of the slots proportional to its weight (weighted fair
+# queuing), so one tenant's burst can't starve the others.
+# A slot is held for the whole response, streams included, so SCHEDULER_SLOTS
+# caps the concurrent generations of a worker process. It's off by default
+# (0 admits everything immediately).
+SCHEDULER_SLOTS = int(environ.get('SCHEDULER_SLOTS', '0'))
+# Requests waiting in total before new ones get 503
+SCHEDULER_QUEUE = int(environ.get('SCHEDULER_QUEUE', '256'))
+# Requests one tenant may have waiting before its new ones get 429
+SCHEDULER_TENANT_QUEUE = int(environ.get('SCHEDULER_TENANT_QUEUE', '64'))
+# Longest wait for a slot (the request's own deadline may cut it shorter)
+SCHEDULER_MAX_WAIT = float(environ.get('SCHEDULER_MAX_WAIT', '30'))
+# Relative shares per tenant, e.g. "team-a:4,team-b:1"; others weigh 1
+TENANT_WEIGHTS = environ.get('TENANT_WEIGHTS', '')
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, BATCH)
+ANONYMOUS = 'anonymous'
+
+QUEUE_WAIT = Histogram('gpt_queue_wait_seconds', 'Time requests waited for an upstream slot', ('priority',))
+REJECTIONS = Counter('gpt_scheduler_rejections_total', 'Requests turned away by the scheduler', ('priority', 'status'))
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    weights = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        tenant, _, weight = entry.rpartition(':')
+        try:
+            weights[tenant] = max(float(weight), 0.01)
+        except ValueError:
+            logger.warning(f"Ignoring tenant weight {entry!r}")
+    return weights
+
+
+def request_tenant(headers) -> str:
+    # X-Tenant names the tenant; otherwise requests are grouped by API key,
+    # identified by a hash so keys don't end up in logs and metrics
+    tenant = headers.get('X-Tenant')
+    if tenant:
+        return tenant
+    key = headers.get('X-Api-Key') or headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if key:
+        return 'key-' + hashlib.sha256(key.encode()).hexdigest()[:12]
+    return ANONYMOUS
+
+
+def request_priority(headers) -> str:
+    priority = (headers.get('X-Priority') or INTERACTIVE).lower()
+    return priority if priority in PRIORITIES else INTERACTIVE
+
+
+class Overloaded(Exception):
+    # Turned away without queuing: 429 when the tenant has too many requests
+    # waiting, 503 when the whole queue is full or the wait ran out
+    def __init__(self, message: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class Ticket:
+    # An admitted request's upstream slot, given back by release(). A ticket
+    # without a scheduler (cache hits, single-flight joiners) holds nothing.
+    def __init__(self, scheduler: 'Scheduler' = None, tenant: str = ANONYMOUS, priority: str = INTERACTIVE):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.started = self.enqueued
+        self.wait = 0.0
+        self.granted = False
+        self.abandoned = False
+        self.released = False
+        self.future = None
+        self.loop = None
+
+    def release(self):
+        if self.scheduler is not None and self.granted and not self.released:
+            self.released = True
+            self.scheduler.release(self)
+
+    async def hold(self, coro):
+        # Awaits `coro` and frees the slot once it's done
+        try:
+            return await coro
+        finally:
+            self.release()
+
+    def hold_stream(self, events):
+        # Frees the slot once the stream ends or is closed. A stream that is
+        # never started (client gone before the first read) frees it when
+        # garbage collected.
+        stream = self._hold_stream(events)
+        if self.loop is not None:
+            weakref.finalize(stream, self.loop.call_soon_threadsafe, self.release).atexit = False
+        return stream
+
+    async def _hold_stream(self, events):
+        try:
+            async with aclosing(events):
+                async for event in events:
+                    yield event
+        finally:
+            self.release()
+
+    def headers(self) -> dict:
+        return {"X-Queue-Wait": f"{self.wait:.3f}"}
+
+
+class Scheduler:
+    def __init__(self, slots: int = SCHEDULER_SLOTS, queue_limit: int = SCHEDULER_QUEUE,
+                 tenant_limit: int = SCHEDULER_TENANT_QUEUE, max_wait: float = SCHEDULER_MAX_WAIT,
+                 weights: Dict[str, float] = None):
+        self.slots = slots
+        self.queue_limit = queue_limit
+        self.tenant_limit = tenant_limit
+        self.max_wait = max_wait
+        self.weights = parse_weights(TENANT_WEIGHTS) if weights is None else weights
+        self.in_use = 0
+        # Per priority: heap of (virtual finish time, sequence, ticket), the
+        # virtual time of the last dispatch, and each tenant's last finish time
+        self.queues: Dict[str, List] = {priority: [] for priority in PRIORITIES}
+        self.virtual: Dict[str, float] = {priority: 0.0 for priority in PRIORITIES}
+        self.finish: Dict[str, Dict[str, float]] = {priority: {} for priority in PRIORITIES}
+        self.queued: Dict[str, int] = {priority: 0 for priority in PRIORITIES}
+        self.tenant_queued: Dict[str, int] = {}
+        self.sequence = itertools.count()
+        # Moving average of how long a slot is held, for Retry-After
+        self.hold_time = 1.0
+
+    async def admit(self, tenant: str, priority: str = INTERACTIVE, deadline: Optional[float] = None,
+                    bounded: bool = True) -> Ticket:
+        # Waits for a slot and returns its ticket, or raises Overloaded.
+        # Unbounded admissions (batch lines) never get turned away and wait as
+        # long as it takes.
+        ticket = Ticket(self, tenant, priority)
+        if not self.slots or (self.in_use < self.slots and not any(self.queued.values())):
+            self.grant(ticket)
+            QUEUE_WAIT.observe(0.0, (priority,))
+            return ticket
+
+        if bounded and self.tenant_queued.get(tenant, 0) >= self.tenant_limit:
+            self.reject(priority, 429)
+            raise Overloaded(f"Too many queued requests for tenant {tenant}", 429, self.retry_after(priority))
+        if bounded and sum(self.queued.values()) >= self.queue_limit:
+            self.reject(priority, 503)
+            raise Overloaded("Server overloaded, request queue is full", 503, self.retry_after(priority))
+
+        self.enqueue(ticket)
+        timeout = None
+        if bounded:
+            timeout = self.max_wait if deadline is None else min(self.max_wait, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(ticket.future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.granted:
+                # The slot came through just as we gave up
+                ticket.release()
+            else:
+                self.abandon(ticket)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.reject(priority, 503)
+            raise Overloaded(f"No upstream slot within {timeout:.1f}s", 503, self.retry_after(priority))
+        QUEUE_WAIT.observe(ticket.wait, (priority,))
+        if ticket.wait >= 1:
+            logger.info(f"Tenant {tenant} ({priority}) waited {ticket.wait:.2f}s for an upstream slot")
+        return ticket
+
+    def enqueue(self, ticket: Ticket):
+        # A tenant's requests finish 1/weight apart in virtual time, starting
+        # no earlier than the class's current virtual time, so an idle
+        # tenant can't bank credit
+        finish = self.finish[ticket.priority]
+        start = max(self.virtual[ticket.priority], finish.get(ticket.tenant, 0.0))
+        tag = finish[ticket.tenant] = start + 1 / self.weights.get(ticket.tenant, 1.0)
+        ticket.future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queues[ticket.priority], (tag, next(self.sequence), ticket))
+        self.queued[ticket.priority] += 1
+        self.tenant_queued[ticket.tenant] = self.tenant_queued.get(ticket.tenant, 0) + 1
+
+    def dequeued(self, ticket: Ticket):
+        self.queued[ticket.priority] -= 1
+        count = self.tenant_queued[ticket.tenant] = self.tenant_queued[ticket.tenant] - 1
+        if not count:
+            del self.tenant_queued[ticket.tenant]
+            finish = self.finish[ticket.priority]
+            if finish.get(ticket.tenant, 0.0) <= self.virtual[ticket.priority]:
+                finish.pop(ticket.tenant, None)
+
+    def abandon(self, ticket: Ticket):
+        # Left in the heap and skipped when it comes up
+        if ticket.abandoned:
+            return
+        ticket.abandoned = True
+        self.dequeued(ticket)
+
+    def grant(self, ticket: Ticket):
+        self.in_use += 1
+        ticket.granted = True
+        ticket.loop = asyncio.get_running_loop()
+        ticket.started = time.monotonic()
+        ticket.wait = ticket.started - ticket.enqueued
+
+    def release(self, ticket: Ticket):
+        self.hold_time += 0.1 * (time.monotonic() - ticket.started - self.hold_time)
+        self.in_use -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            while queue and (not self.slots or self.in_use < self.slots):
+                tag, _, ticket = heapq.heappop(queue)
+                if ticket.abandoned or ticket.future.done():
+                    # Gave up waiting (timed out or cancelled)
+                    self.abandon(ticket)
+                    continue
+                self.virtual[priority] = tag
+                self.dequeued(ticket)
+                self.grant(ticket)
+                ticket.future.set_result(None)
+
+    def reject(self, priority: str, status: int):
+        REJECTIONS.inc((priority, status))
+
+    def retry_after(self, priority: str) -> int:
+        # Seconds until the requests queued at this priority or above would
+        # have been served at the current pace
+        ahead = sum(self.queued[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        return max(1, math.ceil((ahead + 1) * self.hold_time / max(1, self.slots)))
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "in_use": self.in_use,
+            "queued": dict(self.queued),
+            "tenants_queued": dict(self.tenant_queued),
+            "hold_seconds": round(self.hold_time, 3),
+        }
+
+
+scheduler = Scheduler()
+
+Collected('gpt_scheduler_queued', 'Requests waiting for an upstream slot', ('priority',),
+          lambda: {(priority,): count for priority, count in scheduler.queued.items()})
+Collected('gpt_scheduler_slots_in_use', 'Upstream slots held by admitted requests', (),
+          lambda: {(): scheduler.in_use})
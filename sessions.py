@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from os import environ
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+from response_cache import DiskCache
+
+# Server-side conversations. A request with "session": true starts one and
+# gets its id back in the X-Conversation-Id header (and "conversation_id" in
+# JSON answers); later requests send that "conversation_id" with only the new
+# messages. The stored history is put in front of them and the assistant's
+# reply is appended once it's complete. The system prompt is only read on
+# the first turn.
+SESSION_TTL = float(environ.get('SESSION_TTL', str(24 * 3600)))
+SESSION_MAX_ENTRIES = int(environ.get('SESSION_MAX_ENTRIES', '10000'))
+SESSION_MAX_BYTES = int(environ.get('SESSION_MAX_BYTES', str(256 * 1024 * 1024)))
+# SQLite file conversations evicted from memory spill to, and are read back from
+SESSION_DB = environ.get('SESSION_DB', '')
+
+
+class SessionNotFound(Exception):
+    pass
+
+
+def _size(messages: List) -> int:
+    return sum(len(json.dumps(message, ensure_ascii=False, default=str)) for message in messages)
+
+
+class SessionTurn:
+    # One request's part in a conversation. `pinned` counts the leading
+    # messages holding the system prompt, which context trimming must keep.
+    def __init__(self, store: 'SessionStore', conversation_id: str, history: List, pinned: int = 0):
+        self.store = store
+        self.id = conversation_id
+        self.history = history
+        self.pinned = pinned
+        self.new = []
+
+    def with_history(self, messages: List, pinned: int = 0) -> List:
+        # `pinned` only counts on the first turn
+        self.new = list(messages)
+        if not self.history:
+            self.pinned = pinned
+        return self.history + self.new
+
+    def complete(self, reply: str):
+        # The turn and its answer become part of the conversation
+        self.store.append(self.id, self.new + [{"role": "assistant", "content": reply}], self.pinned)
+
+    def headers(self) -> dict:
+        return {"X-Conversation-Id": self.id}
+
+
+class SessionStore:
+    # LRU of conversations bounded by count and size. Python objects are kept
+    # as they are, so a turn costs no re-parsing of the history; evicted
+    # conversations spill to SESSION_DB when it's set.
+    def __init__(self, ttl: float = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES,
+                 max_bytes: int = SESSION_MAX_BYTES, filename: str = SESSION_DB):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # id -> [messages, size, expires, pinned]
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk = DiskCache(filename) if filename else None
+        if self.disk:
+            self.disk.purge_expired()
+        self.spilled = 0
+
+    def start(self, jsong: dict) -> Optional[SessionTurn]:
+        # The request's turn in session mode, or None when it isn't using it
+        conversation_id = jsong.get('conversation_id')
+        if conversation_id:
+            history, pinned = self.get(conversation_id)
+            if history is None:
+                raise SessionNotFound(f"Unknown or expired conversation_id {conversation_id}")
+            if history:
+                jsong.pop('system', None)
+            return SessionTurn(self, conversation_id, history, pinned)
+        if jsong.get('session'):
+            conversation_id = uuid4().hex
+            with self.lock:
+                self._store(conversation_id, [], 0, time.time() + self.ttl, 0)
+            return SessionTurn(self, conversation_id, [])
+        return None
+
+    def get(self, conversation_id: str) -> Tuple[Optional[List], int]:
+        # (copy of the history, pinned count); the history is None if unknown
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(conversation_id)
+            if entry is not None:
+                if entry[2] >= now:
+                    self.entries.move_to_end(conversation_id)
+                    entry[2] = now + self.ttl
+                    return list(entry[0]), entry[3]
+                self._evict(conversation_id, spill=False)
+        text = self.disk.get(conversation_id) if self.disk else None
+        if text is None:
+            return None, 0
+        conversation = json.loads(text)
+        with self.lock:
+            if conversation_id not in self.entries:
+                self._store(conversation_id, conversation["messages"], len(text), now + self.ttl, conversation["pinned"])
+        return list(conversation["messages"]), conversation["pinned"]
+
+    def append(self, conversation_id: str, messages: List, pinned: int = 0):
+        now = time.time()
+        if conversation_id not in self.entries:
+            # Reads it back from disk if it spilled meanwhile
+            self.get(conversation_id)
+        with self.lock:
+            entry = self.entries.get(conversation_id)
+            if entry is None:
+                # Expired while the reply was generated: start over from this turn
+                self._store(conversation_id, list(messages), _size(messages), now + self.ttl, pinned)
+                return
+            size = _size(messages)
+            entry[0].extend(messages)
+            entry[1] += size
+            entry[2] = now + self.ttl
+            entry[3] = pinned
+            self.size += size
+            self.entries.move_to_end(conversation_id)
+            self._shrink()
+
+    def _store(self, conversation_id: str, messages: List, size: int, expires: float, pinned: int):
+        if conversation_id in self.entries:
+            self._evict(conversation_id, spill=False)
+        self.entries[conversation_id] = [messages, size, expires, pinned]
+        self.size += size
+        self._shrink()
+
+    def _shrink(self):
+        # Never evicts the most recently used conversation
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, conversation_id: str, spill: bool = True):
+        messages, size, expires, pinned = self.entries.pop(conversation_id)
+        self.size -= size
+        if spill and self.disk and expires >= time.time():
+            conversation = {"messages": messages, "pinned": pinned}
+            self.disk.put(conversation_id, json.dumps(conversation, ensure_ascii=False, default=str), expires)
+            self.spilled += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "conversations": len(self.entries),
+                "bytes": self.size,
+                "spilled": self.spilled,
+                "disk": bool(self.disk),
+            }
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from contextlib import aclosing
+from os import environ
+from typing import AsyncIterator, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# SINGLE_FLIGHT=0 sends every request upstream on its own
+SINGLE_FLIGHT = environ.get('SINGLE_FLIGHT', '1') != '0'
+
+
+class Flight:
+    # One upstream generation whose text chunks are shared by every identical
+    # request. Subscribers that join late get the chunks so far replayed first.
+    # The upstream call is cancelled only once the last subscriber has left.
+    def __init__(self, source: AsyncIterator[str], on_done: Callable):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.updated = asyncio.Event()
+        self.on_done = on_done
+        self.task = asyncio.ensure_future(self.run(source))
+
+    async def run(self, source: AsyncIterator[str]):
+        try:
+            async with aclosing(source):
+                async for chunk in source:
+                    self.chunks.append(chunk)
+                    self.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.on_done(self)
+            self.notify()
+
+    def notify(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        try:
+            position = 0
+            while True:
+                if position < len(self.chunks):
+                    position += 1
+                    yield self.chunks[position - 1]
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self.updated.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                # Every client went away: stop paying for the generation
+                self.on_done(self)
+                self.task.cancel()
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+
+    async def stream(self, key: Optional[str], source: Callable[[], AsyncIterator[str]]):
+        # Yields the text chunks of `source()`, sharing one upstream call with
+        # any identical in-flight request
+        if key is None or not SINGLE_FLIGHT:
+            async with aclosing(source()) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+            return
+
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(source(), lambda done: self.forget(key, done))
+        else:
+            logger.info(f"Joining in-flight request {key[:12]} ({len(flight.chunks)} chunks so far)")
+        async with aclosing(flight.subscribe()) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def forget(self, key: str, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def joinable(self, key: Optional[str]) -> bool:
+        return SINGLE_FLIGHT and key is not None and key in self.flights
+
+    def in_flight(self) -> int:
+        return len(self.flights)
@@ -0,0 +1,110 @@
+import asyncio
+from contextlib import aclosing
+from json import dumps
+from json.encoder import encode_basestring_ascii
+from os import environ
+from uuid import uuid4
+
+# SSE framing with the static parts pre-encoded: per chunk, only the text is
+# escaped (by the C JSON string encoder) and joined into a single bytes write.
+# The output is byte-for-byte what json.dumps produced before.
+
+# Coalesce text into one event once this many characters are buffered (the
+# event itself can be several times larger once non-ASCII text is escaped).
+# SSE_COALESCE_BYTES is the old, misleading name of the same setting ...
+SSE_COALESCE_CHARS = int(environ.get('SSE_COALESCE_CHARS', environ.get('SSE_COALESCE_BYTES', '0')))
+# ... or this many seconds after the first buffered chunk (e.g. 0.02)
+SSE_FLUSH_INTERVAL = float(environ.get('SSE_FLUSH_INTERVAL', '0'))
+
+# OpenAI chat.completion.chunk events
+OPENAI_DELTA_PREFIX = b'data: {"choices": [{"delta": {"content": '
+OPENAI_DELTA_SUFFIX = b'}}]}\n\n'
+OPENAI_DONE = b'data: [DONE]\n\n'
+OPENAI_ERROR = b'data: {"error": "All providers failed"}\n\n'
+
+# Anthropic message stream events
+ANTHROPIC_DELTA_PREFIX = (b'event: content_block_delta\ndata: {"type": "content_block_delta", "index": 0, '
+                          b'"delta": {"type": "text_delta", "text": ')
+ANTHROPIC_DELTA_SUFFIX = b'}}\n\n'
+ANTHROPIC_BLOCK_START = (b'event: content_block_start\ndata: {"type": "content_block_start", "index": 0, '
+                         b'"content_block": {"type": "text", "text": ""}}\n\n')
+ANTHROPIC_PING = b'event: ping\ndata: {"type": "ping"}\n\n'
+ANTHROPIC_STOP_PREFIX = (
+    b'event: content_block_stop\ndata: {"type": "content_block_stop", "index": 0}\n\n'
+    b'event: message_delta\ndata: {"type": "message_delta", "delta": {"stop_reason": "end_turn", '
+    b'"stop_sequence": null}, "usage": {"output_tokens": '
+)
+ANTHROPIC_STOP_SUFFIX = b'}}\n\nevent: message_stop\ndata: {"type": "message_stop"}\n\n'
+
+
+def anthropic_stop(output_tokens: int) -> bytes:
+    return ANTHROPIC_STOP_PREFIX + str(output_tokens).encode('ascii') + ANTHROPIC_STOP_SUFFIX
+
+
+def openai_delta(text: str) -> bytes:
+    return OPENAI_DELTA_PREFIX + encode_basestring_ascii(text).encode('ascii') + OPENAI_DELTA_SUFFIX
+
+
+def anthropic_delta(text: str) -> bytes:
+    return ANTHROPIC_DELTA_PREFIX + encode_basestring_ascii(text).encode('ascii') + ANTHROPIC_DELTA_SUFFIX
+
+
+def anthropic_start(model: str, input_tokens: int = 0) -> bytes:
+    message = {'type': 'message_start', 'message': {'id': f'msg_{uuid4().hex}', 'type': 'message', 'role': 'assistant',
+               'content': [], 'model': model, 'stop_reason': None, 'stop_sequence': None,
+               'usage': {'input_tokens': input_tokens, 'output_tokens': 1}}}
+    return f"event: message_start\ndata: {dumps(message)}\n\n".encode('utf-8') + ANTHROPIC_BLOCK_START + ANTHROPIC_PING
+
+
+async def coalesce(chunks, max_chars: int = SSE_COALESCE_CHARS, interval: float = SSE_FLUSH_INTERVAL):
+    # Merge text chunks so each SSE event (and socket write) carries more text.
+    # A buffer is flushed once it holds max_chars, or `interval` seconds after
+    # its first chunk even if nothing else arrives.
+    if max_chars <= 0 and interval <= 0:
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer = []
+    size = 0
+    deadline = None
+    pending = None
+    try:
+        while True:
+            if pending is None and not (buffer and interval > 0):
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                # Wait for the next chunk only until the buffer is due
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(0.0, deadline - loop.time()) if buffer else None
+                done, _ = await asyncio.wait((pending,), timeout=timeout)
+                if not done:
+                    yield ''.join(buffer)
+                    buffer, size = [], 0
+                    continue
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+            if not buffer:
+                deadline = loop.time() + interval
+            buffer.append(chunk)
+            size += len(chunk)
+            if 0 < max_chars <= size:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait((pending,))
+        await iterator.aclose()
@@ -0,0 +1,136 @@
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ
+from typing import List, Optional
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# Per-request timelines of the generation routes: parse, queueing, provider
+# picks, each upstream attempt with its first and last chunk, and backoff
+# sleeps. Every request is traced (a span is a perf_counter call and a list
+# append); when it ends, the trace is kept in a ring buffer if it was slow or
+# something in it failed, and otherwise with probability TRACE_SAMPLE_RATE.
+# /debug/slow dumps the slowest kept traces. TRACING=0 turns it off.
+TRACING = environ.get('TRACING', '1') != '0'
+TRACE_SAMPLE_RATE = float(environ.get('TRACE_SAMPLE_RATE', '0.01'))
+# Requests slower than this are always kept
+TRACE_SLOW_SECONDS = float(environ.get('TRACE_SLOW_SECONDS', '10'))
+TRACE_BUFFER = int(environ.get('TRACE_BUFFER', '1000'))
+# JSONL file every kept trace is also appended to
+TRACE_EXPORT = environ.get('TRACE_EXPORT', '')
+
+_current: ContextVar[Optional['Trace']] = ContextVar('trace', default=None)
+
+
+class Trace:
+    __slots__ = ('id', 'route', 'wall', 'start', 'spans', 'duration', 'status', 'failed')
+
+    def __init__(self, route: str):
+        self.id = uuid4().hex[:16]
+        self.route = route
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.spans = []  # (name, offset, duration or None for a point event, attributes)
+        self.duration = None
+        self.status = None
+        self.failed = False
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "route": self.route,
+            "start": self.wall,
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "status": self.status,
+            "spans": [
+                dict(attributes, name=name, at=round(offset, 6),
+                     **({"duration": round(duration, 6)} if duration is not None else {}))
+                for name, offset, duration, attributes in self.spans
+            ],
+        }
+
+
+class Recorder:
+    def __init__(self, size: int = TRACE_BUFFER, filename: str = TRACE_EXPORT):
+        self.traces = deque(maxlen=size)
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.export = None
+
+    def keep(self, trace: Trace):
+        self.traces.append(trace)
+        if self.filename:
+            line = json.dumps(trace.to_dict()) + '\n'
+            with self.lock:
+                try:
+                    if self.export is None:
+                        self.export = open(self.filename, 'a', encoding='utf-8')
+                    self.export.write(line)
+                    self.export.flush()
+                except OSError as e:
+                    logger.warning(f"Trace export to {self.filename} failed: {str(e)}")
+
+    def slowest(self, count: int) -> List[dict]:
+        return [trace.to_dict() for trace in heapq.nlargest(count, list(self.traces), key=lambda trace: trace.duration)]
+
+
+recorder = Recorder()
+
+
+def begin(route: Optional[str]) -> Optional[Trace]:
+    # Starts the current request's trace; None leaves the request untraced.
+    # Called for every request, so a worker thread never carries the previous
+    # request's trace over.
+    trace = Trace(route) if TRACING and route else None
+    _current.set(trace)
+    return trace
+
+
+def mark(name: str, **attributes):
+    # A point in time on the current trace, e.g. a first chunk
+    trace = _current.get()
+    if trace is not None:
+        trace.spans.append((name, time.perf_counter() - trace.start, None, attributes))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    # Times the block on the current trace. The span is added when the block
+    # exits, so attributes set on the yielded dict (e.g. the outcome) show up.
+    trace = _current.get()
+    if trace is None:
+        yield attributes
+        return
+    start = time.perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        attributes.setdefault('error', str(e) or type(e).__name__)
+        trace.failed = True
+        raise
+    except BaseException:
+        # The client went away
+        attributes['cancelled'] = True
+        raise
+    finally:
+        trace.spans.append((name, start - trace.start, time.perf_counter() - start, attributes))
+
+
+def finish(status: str = 'ok'):
+    # Ends the current trace; called once the response is fully sent
+    trace = _current.get()
+    if trace is None or trace.duration is not None:
+        return
+    trace.duration = time.perf_counter() - trace.start
+    trace.status = status
+    if (status != 'ok' or trace.failed or trace.duration >= TRACE_SLOW_SECONDS
+            or random.random() < TRACE_SAMPLE_RATE):
+        recorder.keep(trace)
@@ -0,0 +1,147 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from json import dumps
+from os import environ, path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from metrics import Counter
+
+# Segment-level translation memory for /v1/direct. A document is split into
+# sentences and lines; segments translated before (same system prompt, target
+# language and model) come from the store, and only the new ones go upstream,
+# together in one prompt. TRANSLATION_MEMORY=1 turns it on for every request;
+# a request can also set "translation_memory": true or false itself.
+TRANSLATION_MEMORY = environ.get('TRANSLATION_MEMORY', '0') != '0'
+TRANSLATION_MEMORY_DB = environ.get('TRANSLATION_MEMORY_DB', 'translation_memory.db')
+
+# Segment boundaries: line breaks, and whitespace after sentence-ending
+# punctuation unless a lowercase letter follows (abbreviations like "e.g.")
+SEGMENT_BOUNDARY = re.compile(r'(\s*\n\s*|(?<=[.!?。！？])\s+(?=[^a-z\s]))')
+SEGMENT_TAG = re.compile(r'<s id="?(\d+)"?>(.*?)</s>', re.S)
+
+BATCH_INSTRUCTIONS = (
+    "The text to translate is split into numbered segments, each wrapped as <s id=\"N\">...</s>. "
+    "Translate every segment on its own and answer with exactly the same tags and ids, one per "
+    "segment, in the same order, with nothing outside the tags."
+)
+
+SEGMENTS = Counter('gpt_translation_memory_segments_total', 'Translation memory segment lookups by result', ('result',))
+
+
+def memory_document(jsong: dict) -> Optional[str]:
+    # The text of a request translation memory can handle: a single user
+    # message with plain string content
+    messages = jsong.get('messages')
+    if (isinstance(messages, list) and len(messages) == 1 and isinstance(messages[0], dict)
+            and messages[0].get('role', 'user') == 'user' and isinstance(messages[0].get('content'), str)):
+        return messages[0]['content']
+    return None
+
+
+def memory_enabled(jsong: dict) -> bool:
+    return bool(jsong.get('translation_memory', TRANSLATION_MEMORY))
+
+
+def split_segments(text: str) -> List[Tuple[str, bool]]:
+    # (piece, translatable) pairs that join back into `text`. Separators,
+    # surrounding whitespace and pieces without letters are kept verbatim.
+    pieces = []
+    for i, part in enumerate(SEGMENT_BOUNDARY.split(text)):
+        if not part:
+            continue
+        segment = part.strip()
+        if i % 2 or not segment:
+            pieces.append((part, False))
+            continue
+        start = part.index(segment)
+        if start:
+            pieces.append((part[:start], False))
+        pieces.append((segment, any(c.isalpha() for c in segment)))
+        if start + len(segment) < len(part):
+            pieces.append((part[start + len(segment):], False))
+    return pieces
+
+
+def batch_messages(system: str, segments: List[str]) -> List[dict]:
+    # Same layout as with_system: the system prompt goes first as a user message
+    tagged = '\n'.join(f'<s id="{i}">{segment}</s>' for i, segment in enumerate(segments, 1))
+    return [
+        {"role": "user", "content": f"{system}\n\n{BATCH_INSTRUCTIONS}".strip()},
+        {"role": "user", "content": tagged},
+    ]
+
+
+def parse_batch(answer: str, count: int) -> Optional[List[str]]:
+    # Translations in segment order, or None unless every segment came back
+    found = {}
+    for number, text in SEGMENT_TAG.findall(answer):
+        found.setdefault(int(number), text.strip())
+    if any(i not in found or not found[i] for i in range(1, count + 1)):
+        return None
+    return [found[i] for i in range(1, count + 1)]
+
+
+def memory_context(system: str, target: str, model: str) -> str:
+    return dumps([system, target, model], ensure_ascii=False)
+
+
+def segment_key(context: str, segment: str) -> str:
+    return hashlib.sha256(f"{context}\n{segment}".encode('utf-8')).hexdigest()
+
+
+class TranslationMemory:
+    # Persistent segment store in SQLite, shared by the worker processes
+    # opening the same file
+    def __init__(self, filename: str = TRANSLATION_MEMORY_DB):
+        self.filename = filename
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, so the file only appears when the mode is used
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None, timeout=5)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, source TEXT, target TEXT, updated REAL)")
+        return self.db
+
+    def lookup(self, context: str, segments: Iterable[str]) -> Dict[str, str]:
+        keys = {segment_key(context, segment): segment for segment in segments}
+        found = {}
+        with self.lock:
+            db = self._connect()
+            items = list(keys)
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(items), 500):
+                batch = items[i:i + 500]
+                rows = db.execute(f"SELECT key, target FROM segments WHERE key IN ({','.join('?' * len(batch))})", batch)
+                found.update((keys[key], target) for key, target in rows)
+        SEGMENTS.inc(('hit',), len(found))
+        SEGMENTS.inc(('miss',), len(keys) - len(found))
+        return found
+
+    def store(self, context: str, translations: Iterable[Tuple[str, str]]):
+        now = time.time()
+        rows = [(segment_key(context, source), source, target, now) for source, target in translations]
+        with self.lock:
+            db = self._connect()
+            db.execute("BEGIN")
+            try:
+                db.executemany("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)", rows)
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> dict:
+        with self.lock:
+            if self.db is None and not path.exists(self.filename):
+                # Not used yet: don't create the file just to count nothing
+                count = 0
+            else:
+                count = self._connect().execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+        return {"enabled": TRANSLATION_MEMORY, "segments": count, "file": self.filename}
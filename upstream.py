@@ -0,0 +1,114 @@
+import asyncio
+import inspect
+import logging
+from os import environ
+from typing import Dict, Tuple
+
+from aiohttp import TCPConnector
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive connection pools for upstream requests, one per provider. The
+# Flask views run generation on the shared background loop (aio.get_loop), so
+# every request thread uses the same pools. UPSTREAM_POOL=0 disables them.
+UPSTREAM_POOL = environ.get('UPSTREAM_POOL', '1') != '0'
+# Connections per provider, across all hosts it talks to
+UPSTREAM_POOL_SIZE = int(environ.get('UPSTREAM_POOL_SIZE', '32'))
+# Idle keep-alive connections are closed after this many seconds
+UPSTREAM_IDLE_SECONDS = float(environ.get('UPSTREAM_IDLE_SECONDS', '60'))
+DNS_CACHE_SECONDS = 300
+
+
+class PooledConnector(TCPConnector):
+    # Providers wrap the connector they're given in a ClientSession that owns
+    # it and closes it at the end of the request. Ignore that so connections
+    # outlive the request; the pool closes connectors itself on shutdown.
+    async def close(self, *args, **kwargs):
+        pass
+
+    async def shutdown(self):
+        result = TCPConnector.close(self)
+        if inspect.isawaitable(result):
+            await result
+
+
+def accepts_connector(provider) -> bool:
+    # Only providers that build their aiohttp session from a `connector`
+    # argument can use the pool. Others create their own sessions (curl_cffi,
+    # or g4f's loop-wide shared connector) and are left alone.
+    create = getattr(provider, 'create_async_generator', None)
+    if create is None:
+        return False
+    try:
+        return 'connector' in inspect.signature(create).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+class ConnectionPool:
+    def __init__(self, size: int = UPSTREAM_POOL_SIZE, idle: float = UPSTREAM_IDLE_SECONDS, enabled: bool = UPSTREAM_POOL):
+        self.size = size
+        self.idle = idle
+        self.enabled = enabled
+        self.connectors: Dict[str, Tuple[asyncio.AbstractEventLoop, PooledConnector]] = {}
+        self.supported: Dict[str, bool] = {}
+        self.requests: Dict[str, int] = {}
+        self.created: Dict[str, int] = {}
+
+    def kwargs(self, provider) -> dict:
+        # Extra create_async arguments routing `provider` through its pool
+        if not self.enabled:
+            return {}
+        name = provider.__name__
+        if name not in self.supported:
+            self.supported[name] = accepts_connector(provider)
+        if not self.supported[name]:
+            return {}
+        return {"connector": self.connector(name)}
+
+    def connector(self, name: str) -> PooledConnector:
+        # Connectors are bound to the loop that created them
+        loop = asyncio.get_running_loop()
+        entry = self.connectors.get(name)
+        if entry is None or entry[0] is not loop or entry[1].closed:
+            connector = PooledConnector(limit=self.size, keepalive_timeout=self.idle,
+                                        ttl_dns_cache=DNS_CACHE_SECONDS, enable_cleanup_closed=True)
+            self.connectors[name] = entry = (loop, connector)
+            self.created[name] = self.created.get(name, 0) + 1
+        self.requests[name] = self.requests.get(name, 0) + 1
+        return entry[1]
+
+    async def close(self):
+        connectors, self.connectors = self.connectors, {}
+        for _, connector in connectors.values():
+            await connector.shutdown()
+
+    def connections(self) -> dict:
+        # Open connections per provider, in use and idle (kept alive)
+        counts = {}
+        for name, (_, connector) in list(self.connectors.items()):
+            idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+            counts[(name, 'active')] = len(getattr(connector, '_acquired', ()))
+            counts[(name, 'idle')] = idle
+        return counts
+
+    def stats(self) -> dict:
+        connections = self.connections()
+        return {
+            "enabled": self.enabled,
+            "size": self.size,
+            "idle_seconds": self.idle,
+            "providers": {
+                name: {
+                    "requests": self.requests.get(name, 0),
+                    "connectors_created": self.created.get(name, 0),
+                    "active": connections.get((name, 'active'), 0),
+                    "idle": connections.get((name, 'idle'), 0),
+                }
+                for name in self.connectors
+            },
+            "unpooled": sorted(name for name, supported in self.supported.items() if not supported),
+        }
+
+
+pool = ConnectionPool()
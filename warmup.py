@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from os import environ
+from typing import Dict, List
+
+from aio import complete
+from providers import HEALTH_CHECK_PROMPT, HEALTH_CHECK_TIMEOUT, AutoProvider
+
+logger = logging.getLogger(__name__)
+
+# WARMUP=1 sends each provider a probe request in the background at startup,
+# so sessions and cookies are set up before real traffic arrives
+WARMUP_ENABLED = environ.get('WARMUP', '0') != '0'
+# /readyz reports ready once this many providers answered their probe (or
+# every probe finished, whatever the outcome)
+READY_MIN_WARM = int(environ.get('READY_MIN_WARM', '1'))
+
+PENDING = 'pending'
+WARMING = 'warming'
+WARM = 'warm'
+FAILED = 'failed'
+
+
+class Warmup:
+    def __init__(self, auto_provider: AutoProvider, enabled: bool = WARMUP_ENABLED):
+        self.auto_provider = auto_provider
+        self.enabled = enabled
+        self.states: Dict[str, str] = {p.__name__: PENDING for p in auto_provider.providers} if enabled else {}
+        self.started = time.monotonic()
+        self.finished = None
+        self.task = None
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        if not self.enabled or self.task is not None:
+            return
+        if loop is None:
+            self.task = asyncio.ensure_future(self.run())
+        else:
+            self.task = asyncio.run_coroutine_threadsafe(self.run(), loop)
+
+    async def run(self):
+        # One probe going wrong mustn't keep warm-up from finishing
+        await asyncio.gather(*[self.warm(provider) for provider in self.auto_provider.providers], return_exceptions=True)
+        self.finished = time.monotonic()
+        logger.info(f"Warm-up finished in {self.finished - self.started:.1f}s: {self.count(WARM)} of {len(self.states)} providers warm")
+
+    async def warm(self, provider):
+        # Counts as a real request, so the result seeds the provider's score
+        # and circuit breaker too
+        name = provider.__name__
+        self.states[name] = WARMING
+        self.auto_provider.claim(provider)
+        start = time.monotonic()
+        try:
+            text = await asyncio.wait_for(complete(provider, HEALTH_CHECK_PROMPT, timeout=HEALTH_CHECK_TIMEOUT), HEALTH_CHECK_TIMEOUT)
+            # Raises EmptyResponse for an empty answer
+            self.auto_provider.record_response(provider, time.monotonic() - start, text)
+        except Exception as e:
+            logger.info(f"Warm-up of {name} failed: {str(e) or type(e).__name__}")
+            self.auto_provider.mark_failed(provider, e)
+            self.states[name] = FAILED
+            return
+        self.states[name] = WARM
+
+    def count(self, state: str) -> int:
+        return sum(1 for value in self.states.values() if value == state)
+
+    def ready(self) -> bool:
+        if not self.enabled:
+            return True
+        return self.finished is not None or self.count(WARM) >= min(READY_MIN_WARM, len(self.states))
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready(),
+            "warmup": self.enabled,
+            "warm": self.count(WARM),
+            "failed": self.count(FAILED),
+            "total": len(self.states),
+            "elapsed": round((self.finished or time.monotonic()) - self.started, 3),
+            "providers": dict(self.states),
+        }
+
+
+def load_providers(names: List[str]) -> List:
+    # Resolves only the configured providers, by name. g4f loads provider
+    # modules on first access, and one missing from the installed g4f is
+    # skipped instead of failing startup.
+    from g4f import Provider
+
+    providers = []
+    for name in names:
+        try:
+            providers.append(getattr(Provider, name))
+        except (AttributeError, ImportError) as e:
+            logger.warning(f"Skipping provider {name}: {str(e)}")
+    return providers